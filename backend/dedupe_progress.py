@@ -0,0 +1,82 @@
+# dedupe_progress.py — limpieza única de progresos duplicados
+# pylint: disable=missing-module-docstring,missing-function-docstring,line-too-long
+#
+# El índice único progress.user_id no se puede crear si ya hay más de un
+# progreso por usuario (server.py no arranca en ese caso). Este script deja
+# el de updated_at más reciente y borra el resto.
+#
+#   python dedupe_progress.py            # solo informa qué borraría
+#   python dedupe_progress.py --apply    # respalda en JSONL y borra
+#
+# Correrlo una sola vez, con el backend detenido.
+
+import argparse
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+from bson import json_util
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / ".env")
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger("dedupe_progress")
+
+
+def find_duplicates(progress) -> list:
+    """[(user_id, [docs del más nuevo al más viejo])] para los usuarios con más de un progreso."""
+    pipeline = [
+        {"$sort": {"updated_at": -1}},
+        {"$group": {"_id": "$user_id", "docs": {"$push": "$$ROOT"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}},
+    ]
+    return [(group["_id"], group["docs"]) for group in progress.aggregate(pipeline, allowDiskUse=True)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Deja un solo progreso por user_id (el más reciente).")
+    parser.add_argument("--apply", action="store_true", help="borra de verdad (sin esto solo informa)")
+    parser.add_argument("--backup", type=Path, help="JSONL con los documentos borrados")
+    args = parser.parse_args()
+
+    client = MongoClient(os.environ["MONGO_URL"])
+    progress = client[os.environ["DB_NAME"]].progress
+
+    duplicates = find_duplicates(progress)
+    if not duplicates:
+        logger.info("No hay progresos duplicados")
+        return
+
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    backup = args.backup or ROOT_DIR / f"progress_duplicates_{stamp}.jsonl"
+    removed = 0
+    with open(backup, "a", encoding="utf-8") if args.apply else open(os.devnull, "w", encoding="utf-8") as out:
+        for user_id, docs in duplicates:
+            keep, extra = docs[0], docs[1:]
+            logger.info(
+                "user_id=%s: se conserva %s (updated_at=%s), se borran %s",
+                user_id,
+                keep["_id"],
+                keep.get("updated_at"),
+                [str(d["_id"]) for d in extra],
+            )
+            if not args.apply:
+                continue
+            for doc in extra:
+                out.write(json_util.dumps(doc) + "\n")
+            out.flush()
+            result = progress.delete_many({"_id": {"$in": [d["_id"] for d in extra]}})
+            removed += result.deleted_count
+
+    if args.apply:
+        logger.info("Borrados %s progresos duplicados de %s usuarios (respaldo: %s)", removed, len(duplicates), backup)
+    else:
+        logger.info("%s usuarios con progresos duplicados; usa --apply para borrarlos", len(duplicates))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,25 +2,93 @@
 # pylint: disable=missing-module-docstring,missing-class-docstring,missing-function-docstring,line-too-long,wrong-import-order,unused-variable
 
 # ------------------------ IMPORTS (ordenados) ------------------------
+import asyncio
+import base64
+import gzip
+import hashlib
+import io
+import json
 import logging
+import math
+import mimetypes
 import os
-from datetime import datetime, timezone
+import secrets
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from pathlib import Path
 from typing import Dict, List, Optional
 
+import anyio
+import jwt
+import numpy as np
 from bson import ObjectId
 from dotenv import load_dotenv
-from fastapi import APIRouter, FastAPI, HTTPException, Request
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from motor.motor_asyncio import AsyncIOMotorClient
+from PIL import Image, ImageOps
 from pydantic import BaseModel, Field
+from pymongo import monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
 
 # ------------------------ CONFIG INICIAL -----------------------------
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / ".env")
 
+# Comandos de Mongo por request (para el registro de requests lentos).
+# Motor ejecuta pymongo en un executor copiando el contexto, así que el
+# listener ve la traza del request que originó cada comando.
+_request_trace: ContextVar[Optional[Dict]] = ContextVar("request_trace", default=None)
+TRACE_MAX_COMMANDS = 200
+# Total de comandos enviados a Mongo por "comando:colección" (ver /api/debug/mongo-commands)
+mongo_command_counts: Counter = Counter()
+_mongo_counts_lock = threading.Lock()
+
+
+class MongoCommandRecorder(monitoring.CommandListener):
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = None
+        with _mongo_counts_lock:
+            mongo_command_counts[f"{event.command_name}:{collection}"] += 1
+
+        trace = _request_trace.get()
+        if trace is None or len(trace["mongo"]) >= TRACE_MAX_COMMANDS:
+            return
+        entry = {
+            "command": event.command_name,
+            "collection": collection,
+            "duration_ms": None,
+            "ok": None,
+        }
+        trace["mongo"].append(entry)
+        trace["pending"][event.request_id] = entry
+
+    def _finish(self, event, ok: bool):
+        trace = _request_trace.get()
+        entry = trace["pending"].pop(event.request_id, None) if trace is not None else None
+        if entry is not None:
+            entry["duration_ms"] = round(event.duration_micros / 1000, 3)
+            entry["ok"] = ok
+
+    def succeeded(self, event):
+        self._finish(event, True)
+
+    def failed(self, event):
+        self._finish(event, False)
+
+
 mongo_url = os.environ["MONGO_URL"]
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandRecorder()])
 db = client[os.environ["DB_NAME"]]
 
 logging.basicConfig(
@@ -45,6 +113,68 @@ def bad_request(msg: str, err: Exception):
     raise HTTPException(status_code=400, detail=msg) from err
 
 
+# ------------------------ SINGLE-FLIGHT ------------------------------
+# Lecturas idénticas concurrentes (misma ruta + id) comparten una sola
+# consulta en vuelo: la primera la ejecuta y las demás esperan su resultado.
+class SingleFlight:
+    def __init__(self):
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    async def do(self, key: tuple, fn):
+        stats = self.stats.setdefault(key[0], {"calls": 0, "executions": 0})
+        stats["calls"] += 1
+        fut = self._inflight.get(key)
+        if fut is None:
+            stats["executions"] += 1
+            fut = asyncio.ensure_future(fn())
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda done: self._forget(key, done))
+        # shield: si un cliente cancela, la consulta sigue para los demás
+        return await asyncio.shield(fut)
+
+    def _forget(self, key: tuple, fut: asyncio.Future) -> None:
+        if self._inflight.get(key) is fut:
+            del self._inflight[key]
+        if not fut.cancelled():
+            fut.exception()  # evita "exception was never retrieved" si nadie esperaba
+
+
+single_flight = SingleFlight()
+
+
+# ------------------------ CACHÉ EN MEMORIA ---------------------------
+class _BytesLRU:
+    """LRU simple en memoria (clave -> bytes), acotada por número de entradas
+    y/o por bytes totales. Solo se usa desde el event loop."""
+
+    def __init__(self, max_items: Optional[int] = None, max_bytes: Optional[int] = None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._data: "OrderedDict[str, bytes]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        if self.max_bytes is not None and len(value) > self.max_bytes:
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.total_bytes -= len(old)
+        self._data[key] = value
+        self.total_bytes += len(value)
+        while (self.max_items is not None and len(self._data) > self.max_items) or (
+            self.max_bytes is not None and self.total_bytes > self.max_bytes
+        ):
+            _, evicted = self._data.popitem(last=False)
+            self.total_bytes -= len(evicted)
+
+
 # ------------------------ ENDPOINTS DE PRUEBA ------------------------
 @api_router.get("/health")
 async def health():
@@ -81,6 +211,11 @@ class UserCreate(BaseModel):
     avatar_config: Dict = Field(default_factory=lambda: {"color": "blue", "style": "default"})
 
 
+class BulkStudents(BaseModel):
+    students: List[UserCreate]
+    selected_level: str = "primaria"
+
+
 class UserLogin(BaseModel):
     username: str
 
@@ -99,6 +234,12 @@ class UserResponse(BaseModel):
     selected_level: str
 
 
+class AuthResponse(UserResponse):
+    access_token: str
+    token_type: str = "bearer"
+    expires_in: int
+
+
 class Progress(BaseModel):
     user_id: str
     completed_modules: List[str] = Field(default_factory=list)
@@ -121,6 +262,40 @@ class LemonadeGameState(BaseModel):
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 
+class GameSession(BaseModel):
+    user_id: str
+    module: str  # id de módulo (lemonade_stand, savings_challenge, ...) o "inicial/<juego>"
+    score: int = 0
+    coins_earned: int = 0
+    xp_earned: int = 0
+    duration_seconds: Optional[float] = None
+    completed: bool = True
+    details: Dict = Field(default_factory=dict)
+    finished_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class InterestCalc(BaseModel):
+    principals: List[float] = Field(default_factory=lambda: [100.0])
+    rates: List[float]  # % anual, como en la pantalla de interés
+    frequencies: List[int] = Field(default_factory=lambda: [1])  # capitalizaciones por año
+    years: int = 5
+
+
+class SavingsPlanCalc(BaseModel):
+    initial: float = 0.0
+    weekly_deposits: List[float]
+    rates: List[float] = Field(default_factory=lambda: [0.0])  # % anual sobre lo ahorrado
+    goals: List[float] = Field(default_factory=list)
+    weeks: int = 12
+
+
+class MarketTrade(BaseModel):
+    user_id: str
+    symbol: str
+    side: str  # "buy" | "sell"
+    quantity: int
+
+
 class CoinUpdate(BaseModel):
     user_id: str
     coins: int
@@ -163,6 +338,25 @@ def calculate_level_from_xp(xp: int) -> int:
     return max(1, (xp // 100) + 1)
 
 
+ALLOWED_LEVELS = ("inicial", "primaria", "secundaria")
+
+
+def new_user_doc(username: str, age: int, avatar_config: Dict, selected_level: str, now: datetime) -> Dict:
+    return {
+        "username": username,
+        "age": age,
+        "avatar_config": avatar_config,
+        "coins": 0,
+        "level": 1,
+        "xp": 0,
+        "badges": [],
+        "purchased_items": [],
+        "equipped_items": {},
+        "selected_level": selected_level,
+        "created_at": now,
+    }
+
+
 def user_dict_to_response(user_dict) -> Optional[UserResponse]:
     if not user_dict or not isinstance(user_dict, dict):
         logger.error("user_dict_to_response recibió datos inválidos: %s", user_dict)
@@ -223,43 +417,262 @@ def normalize_cat_to_en(cat: str) -> str:
     return cat_lower
 
 
-# ------------------------ AUTH ---------------------------------------
-@api_router.post("/auth/register", response_model=UserResponse)
-async def register(user_data: UserCreate, request: Request):
-    try:
-        raw_body = await request.json()
-        logger.info("==> REGISTRO (raw): %s", raw_body)
-    except Exception as e:  # pylint: disable=broad-exception-caught
-        bad_request("JSON inválido", e)
+# ------------------------ LOGROS (reglas de insignias) ---------------
+# Reglas declarativas "métrica >= umbral". Se compilan una vez en un índice
+# evento -> reglas, así cada endpoint solo evalúa las reglas que sus cambios
+# pueden disparar. Las métricas del documento de usuario se evalúan dentro
+# del mismo update de Mongo (pipeline); las de progreso, en Python.
+BADGE_RULES = [
+    {"badge_id": "first_module", "metric": "completed_modules", "gte": 1},
+    {"badge_id": "lemonade_master", "metric": "completed:lemonade_stand", "gte": 1},
+    {"badge_id": "saver", "metric": "completed:savings_challenge", "gte": 1},
+    {"badge_id": "financial_wizard", "metric": "completed_modules", "gte": 4},
+    {"badge_id": "xp_master", "metric": "xp", "gte": 1000},
+    {"badge_id": "coin_collector", "metric": "coins", "gte": 200},
+    {"badge_id": "first_purchase", "metric": "purchased_items", "gte": 1},
+]
+
+# métrica -> (origen, eventos que pueden hacerla crecer)
+BADGE_METRICS = {
+    "xp": ("user", {"add_xp"}),
+    "coins": ("user", {"add_xp", "add_coins"}),
+    "purchased_items": ("user", {"purchase_item"}),
+    "completed_modules": ("progress", {"update_progress"}),
+    "total_score": ("progress", {"update_progress"}),
+    "completed": ("progress", {"update_progress"}),  # completed:<module_id>
+    "score": ("progress", {"update_progress"}),  # score:<module_id>
+}
 
-    logger.info("==> REGISTRO (validados): %s", user_data.dict())
 
-    try:
-        existing_user = await db.users.find_one({"username": user_data.username})
-    except Exception as e:  # pylint: disable=broad-exception-caught
-        http_500("Error al verificar el usuario", e)
+def _split_metric(metric: str) -> tuple:
+    kind, _, arg = metric.partition(":")
+    if kind not in BADGE_METRICS or (kind in ("completed", "score")) != bool(arg):
+        raise ValueError(f"Métrica de insignia desconocida: {metric}")
+    return kind, arg
+
+
+def compile_badge_rules(rules: List[Dict]) -> Dict[str, tuple]:
+    index: Dict[str, list] = {}
+    for rule in rules:
+        kind, _ = _split_metric(rule["metric"])
+        for event in BADGE_METRICS[kind][1]:
+            index.setdefault(event, []).append(rule)
+    return {event: tuple(event_rules) for event, event_rules in index.items()}
 
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Usuario ya existe")
 
+BADGE_RULES_BY_EVENT = compile_badge_rules(BADGE_RULES)
+
+
+def badge_metric_value(metric: str, doc: Dict) -> float:
+    kind, arg = _split_metric(metric)
+    if kind in ("xp", "coins", "total_score"):
+        return doc.get(kind) or 0
+    if kind in ("purchased_items", "completed_modules"):
+        return len(doc.get(kind) or [])
+    if kind == "completed":
+        return 1 if arg in (doc.get("completed_modules") or []) else 0
+    return (doc.get("module_scores") or {}).get(arg, 0)
+
+
+def earned_badges(event: str, doc: Dict) -> List[str]:
+    """Insignias del evento cuyas reglas cumple `doc` (estado posterior al cambio)."""
+    earned: List[str] = []
+    for rule in BADGE_RULES_BY_EVENT.get(event, ()):
+        if rule["badge_id"] not in earned and badge_metric_value(rule["metric"], doc) >= rule["gte"]:
+            earned.append(rule["badge_id"])
+    return earned
+
+
+def _badge_metric_expr(metric: str) -> Dict:
+    kind, _ = _split_metric(metric)
+    if kind == "purchased_items":
+        return {"$size": {"$ifNull": ["$purchased_items", []]}}
+    return {"$ifNull": [f"${kind}", 0]}
+
+
+def badge_pipeline_stage(event: str) -> Optional[Dict]:
+    """Etapa $set que añade a `badges` las insignias de usuario ganadas. None si el
+    evento no tiene reglas sobre el documento de usuario."""
+    rules = [r for r in BADGE_RULES_BY_EVENT.get(event, ()) if BADGE_METRICS[_split_metric(r["metric"])[0]][0] == "user"]
+    if not rules:
+        return None
+    current = {"$ifNull": ["$badges", []]}
+    candidates = [
+        {"$cond": [{"$gte": [_badge_metric_expr(r["metric"]), r["gte"]]}, {"$literal": r["badge_id"]}, None]}
+        for r in rules
+    ]
+    new_badges = {
+        "$filter": {
+            "input": candidates,
+            "cond": {"$and": [{"$ne": ["$$this", None]}, {"$not": [{"$in": ["$$this", current]}]}]},
+        }
+    }
+    return {"$set": {"badges": {"$concatArrays": [current, new_badges]}}}
+
+
+def new_badges_after(event: str, before: Dict, changes: Dict) -> List[str]:
+    """Repite en Python la evaluación del pipeline para informar qué se ganó."""
+    owned = set(before.get("badges") or [])
+    return [b for b in earned_badges(event, {**before, **changes}) if b not in owned]
+
+
+# ------------------------ USERNAMES (filtro Bloom) -------------------
+# Índice en memoria de los usernames existentes. Un "no" del filtro es
+# definitivo (el nombre está libre) y no toca Mongo; un "quizá" se confirma
+# con una lectura por el índice único de users.username.
+USERNAME_BLOOM_CAPACITY = int(os.environ.get("USERNAME_BLOOM_CAPACITY", "200000"))
+USERNAME_BLOOM_FP_RATE = float(os.environ.get("USERNAME_BLOOM_FP_RATE", "0.01"))
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, fp_rate: float):
+        self.num_bits = max(8, int(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.capacity = capacity
+        self.count = 0
+
+    def _positions(self, value: str):
+        # doble hashing (Kirsch-Mitzenmacher) sobre un solo blake2b
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, value: str) -> None:
+        for pos in self._positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+        if self.count == self.capacity + 1:
+            logger.warning("Filtro de usernames supera su capacidad (%s); subir USERNAME_BLOOM_CAPACITY", self.capacity)
+
+    def __contains__(self, value: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(value))
+
+
+username_bloom = BloomFilter(USERNAME_BLOOM_CAPACITY, USERNAME_BLOOM_FP_RATE)
+# Hasta que termine la carga inicial, el filtro no puede dar negativos fiables
+_username_bloom_ready = asyncio.Event()
+# register confía en el índice único para rechazar duplicados; si no se pudo
+# crear (p. ej. ya hay nombres repetidos), vuelve a la lectura previa
+_username_index_ready = asyncio.Event()
+
+
+async def load_username_bloom() -> None:
+    loaded = 0
+    async for doc in db.users.find({}, {"username": 1, "_id": 0}, batch_size=5000):
+        username = doc.get("username")
+        if username:
+            username_bloom.add(username)
+            loaded += 1
+    _username_bloom_ready.set()
+    logger.info("Filtro de usernames cargado: %s nombres", loaded)
+
+
+async def is_username_taken(username: str) -> bool:
+    if _username_bloom_ready.is_set() and username not in username_bloom:
+        return False
+    return await db.users.find_one({"username": username}, {"_id": 1}) is not None
+
+
+# ------------------------ TOKENS DE SESIÓN ---------------------------
+# login/register emiten un JWT firmado (HS256) con el id y el nivel elegido.
+# Los endpoints que modifican datos lo verifican sin tocar Mongo: un usuario
+# inválido se rechaza antes de cualquier consulta.
+JWT_ALGORITHM = "HS256"
+JWT_TTL_MINUTES = int(os.environ.get("JWT_TTL_MINUTES", "60"))
+JWT_SECRET = os.environ.get("JWT_SECRET") or ""
+if not JWT_SECRET:
+    JWT_SECRET = secrets.token_urlsafe(32)
+    logger.warning("JWT_SECRET no definido: se usa una clave temporal (los tokens no sobreviven reinicios)")
+
+bearer_scheme = HTTPBearer(auto_error=False)
+
+
+def issue_token(user_id: str, selected_level: str) -> str:
     now = datetime.now(timezone.utc)
-    user_dict_for_db = {
-        "username": user_data.username,
-        "age": user_data.age,
-        "avatar_config": user_data.avatar_config,
-        "coins": 0,
-        "level": 1,
-        "xp": 0,
-        "badges": [],
-        "purchased_items": [],
-        "equipped_items": {},
-        "selected_level": "primaria",
-        "created_at": now,
+    claims = {
+        "sub": user_id,
+        "lvl": selected_level,
+        "iat": now,
+        "exp": now + timedelta(minutes=JWT_TTL_MINUTES),
     }
+    return jwt.encode(claims, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+
+@lru_cache(maxsize=4096)
+def _verified_claims(token: str) -> Dict:
+    # La firma se verifica una vez por token; la expiración se revisa en cada uso
+    return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM], options={"verify_exp": False})
+
+
+async def current_token(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme)) -> Dict:
+    if credentials is None:
+        raise HTTPException(status_code=401, detail="Token requerido", headers={"WWW-Authenticate": "Bearer"})
+    try:
+        claims = _verified_claims(credentials.credentials)
+    except jwt.InvalidTokenError as e:
+        raise HTTPException(
+            status_code=401, detail="Token inválido", headers={"WWW-Authenticate": "Bearer"}
+        ) from e
+    if claims.get("exp", 0) < time.time() or not ObjectId.is_valid(claims.get("sub")):
+        raise HTTPException(status_code=401, detail="Token expirado", headers={"WWW-Authenticate": "Bearer"})
+    return claims
+
+
+def token_user_id(token: Dict, user_id: str) -> ObjectId:
+    """ObjectId del token, verificando que coincide con el user_id enviado."""
+    if user_id != token["sub"]:
+        raise HTTPException(status_code=403, detail="El token no corresponde a este usuario")
+    return ObjectId(token["sub"])
+
+
+def auth_response(user_dict) -> AuthResponse:
+    response = user_dict_to_response(user_dict)
+    if response is None:
+        raise HTTPException(status_code=500, detail="Error al procesar datos del usuario.")
+    return AuthResponse(
+        **response.dict(),
+        access_token=issue_token(response.id, response.selected_level),
+        expires_in=JWT_TTL_MINUTES * 60,
+    )
+
+
+# Endpoints de docente/administrador (alta masiva, /debug/*): requieren
+# ADMIN_TOKEN en el entorno y el mismo valor en la cabecera X-Admin-Token.
+# Sin ADMIN_TOKEN esos endpoints no existen.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Acceso solo para administradores")
+
+
+# ------------------------ AUTH ---------------------------------------
+@api_router.post("/auth/register", response_model=AuthResponse)
+async def register(user_data: UserCreate):
+    # Solo el username en INFO: volcar el body completo en cada registro bloquea el loop
+    logger.info("==> REGISTRO: %s", user_data.username)
+
+    # Sin lectura previa: el índice único de username rechaza duplicados
+    if not _username_index_ready.is_set():
+        try:
+            existing_user = await db.users.find_one({"username": user_data.username}, {"_id": 1})
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            http_500("Error al verificar el usuario", e)
+        if existing_user:
+            raise HTTPException(status_code=400, detail="Usuario ya existe")
+
+    now = datetime.now(timezone.utc)
+    user_dict_for_db = new_user_doc(user_data.username, user_data.age, user_data.avatar_config, "primaria", now)
 
     try:
         result = await db.users.insert_one(user_dict_for_db)
         inserted_id = result.inserted_id
+        username_bloom.add(user_data.username)
         logger.info("Usuario '%s' creado (ID %s)", user_data.username, inserted_id)
 
         progress_data = Progress(user_id=str(inserted_id), updated_at=now)
@@ -269,26 +682,41 @@ async def register(user_data: UserCreate, request: Request):
         if not created_user_doc:
             raise HTTPException(status_code=500, detail="Error al verificar la creación del usuario")
 
-        response_user = user_dict_to_response(created_user_doc)
-        if response_user is None:
-            raise HTTPException(status_code=500, detail="Error al formatear la respuesta del usuario")
-
-        return response_user
+        return auth_response(created_user_doc)
+    except DuplicateKeyError as e:
+        raise HTTPException(status_code=400, detail="Usuario ya existe") from e
     except HTTPException as e:
         raise HTTPException(status_code=e.status_code, detail=e.detail) from e
     except Exception as e:  # pylint: disable=broad-exception-caught
         http_500("Ocurrió un error interno durante el registro.", e)
 
 
-@api_router.post("/auth/login", response_model=UserResponse)
+@api_router.get("/auth/username-available")
+async def username_available(username: str):
+    if not username.strip():
+        raise HTTPException(status_code=400, detail="Nombre de usuario requerido")
+    try:
+        taken = await is_username_taken(username)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        http_500("Error al verificar el nombre de usuario", e)
+    return {"username": username, "available": not taken}
+
+
+@api_router.post("/auth/login", response_model=AuthResponse)
 async def login(credentials: UserLogin):
     user = await db.users.find_one({"username": credentials.username})
     if not user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
-    response = user_dict_to_response(user)
-    if response is None:
-        raise HTTPException(status_code=500, detail="Error al procesar datos del usuario.")
-    return response
+    return auth_response(user)
+
+
+@api_router.post("/auth/refresh")
+async def refresh_token(token: Dict = Depends(current_token)):
+    return {
+        "access_token": issue_token(token["sub"], token.get("lvl", "primaria")),
+        "token_type": "bearer",
+        "expires_in": JWT_TTL_MINUTES * 60,
+    }
 
 
 # ------------------------ USER ---------------------------------------
@@ -299,7 +727,7 @@ async def get_user(user_id: str):
     except Exception as e:  # pylint: disable=broad-exception-caught
         bad_request("ID de usuario inválido", e)
 
-    user = await db.users.find_one({"_id": obj_id})
+    user = await single_flight.do(("get_user", user_id), lambda: db.users.find_one({"_id": obj_id}))
     if not user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
@@ -310,43 +738,36 @@ async def get_user(user_id: str):
 
 
 @api_router.put("/user/avatar", response_model=UserResponse)
-async def update_avatar(data: AvatarUpdate):
-    try:
-        obj_id = ObjectId(data.user_id)
-    except Exception as e:  # pylint: disable=broad-exception-caught
-        bad_request("ID de usuario inválido", e)
+async def update_avatar(data: AvatarUpdate, token: Dict = Depends(current_token)):
+    obj_id = token_user_id(token, data.user_id)
 
-    result = await db.users.update_one({"_id": obj_id}, {"$set": {"avatar_config": data.avatar_config}})
-    if result.matched_count == 0:
+    user = await db.users.find_one_and_update(
+        {"_id": obj_id}, {"$set": {"avatar_config": data.avatar_config}}, return_document=True
+    )
+    if not user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
-    user = await db.users.find_one({"_id": obj_id})
     response = user_dict_to_response(user)
     if response is None:
         raise HTTPException(status_code=500, detail="Error al procesar datos del usuario.")
     return response
 
 
-@api_router.put("/user/level", response_model=UserResponse)
-async def update_level(data: LevelUpdate):
-    allowed_levels = ["inicial", "primaria", "secundaria"]
-    if data.level not in allowed_levels:
+@api_router.put("/user/level", response_model=AuthResponse)
+async def update_level(data: LevelUpdate, token: Dict = Depends(current_token)):
+    if data.level not in ALLOWED_LEVELS:
         raise HTTPException(status_code=400, detail="Nivel no válido")
 
-    try:
-        obj_id = ObjectId(data.user_id)
-    except Exception as e:  # pylint: disable=broad-exception-caught
-        bad_request("ID de usuario inválido", e)
+    obj_id = token_user_id(token, data.user_id)
 
-    result = await db.users.update_one({"_id": obj_id}, {"$set": {"selected_level": data.level}})
-    if result.matched_count == 0:
+    user = await db.users.find_one_and_update(
+        {"_id": obj_id}, {"$set": {"selected_level": data.level}}, return_document=True
+    )
+    if not user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
-    user = await db.users.find_one({"_id": obj_id})
-    response = user_dict_to_response(user)
-    if response is None:
-        raise HTTPException(status_code=500, detail="Error al procesar datos del usuario.")
-    return response
+    # El nivel viaja en el token: se reemite con el nuevo valor
+    return auth_response(user)
 
 
 # ------------------------ PROGRESS -----------------------------------
@@ -355,27 +776,39 @@ async def get_progress(user_id: str):
     if not user_id:
         raise HTTPException(status_code=400, detail="ID de usuario requerido")
 
-    progress = await db.progress.find_one({"user_id": user_id})
-    if not progress:
-        logger.info("Creando progreso inicial para user_id: %s", user_id)
-        new_progress = Progress(user_id=user_id, updated_at=datetime.now(timezone.utc))
-        try:
-            await db.progress.insert_one(new_progress.dict())
-            progress = await db.progress.find_one({"user_id": user_id})
-            if not progress:
-                raise HTTPException(status_code=500, detail="Error al crear el progreso inicial")
-        except HTTPException as e:
-            raise HTTPException(status_code=e.status_code, detail=e.detail) from e
-        except Exception as e:  # pylint: disable=broad-exception-caught
-            http_500("Error al crear el progreso inicial", e)
+    # Lectura + creación perezosa en un solo upsert (índice único en progress.user_id)
+    def find_or_create():
+        initial = Progress(user_id=user_id, updated_at=datetime.now(timezone.utc)).dict(exclude={"user_id"})
+        return db.progress.find_one_and_update(
+            {"user_id": user_id}, {"$setOnInsert": initial}, upsert=True, return_document=True
+        )
 
+    try:
+        progress = await single_flight.do(("get_progress", user_id), find_or_create)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        http_500("Error al obtener el progreso", e)
+    if not progress:
+        raise HTTPException(status_code=500, detail="Error al crear el progreso inicial")
     return progress
 
 
 @api_router.post("/progress/update")
-async def update_progress(progress_data: Progress):
+async def update_progress(progress_data: Progress, token: Dict = Depends(current_token)):
+    token_user_id(token, progress_data.user_id)
+    # Las insignias de progreso se calculan con los datos enviados y se escriben
+    # en paralelo con el progreso (otro documento), sin lecturas previas.
+    earned = earned_badges("update_progress", progress_data.dict())
+    badge_update = None
+    if earned:
+        badge_update = db.users.find_one_and_update(
+            {"_id": ObjectId(progress_data.user_id), "badges": {"$not": {"$all": earned}}},
+            {"$addToSet": {"badges": {"$each": earned}}},
+            projection={"badges": 1},
+            return_document=False,
+        )
+
     try:
-        result = await db.progress.update_one(
+        progress_update = db.progress.update_one(
             {"user_id": progress_data.user_id},
             {
                 "$set": {
@@ -387,8 +820,13 @@ async def update_progress(progress_data: Progress):
             },
             upsert=True,
         )
+        if badge_update is not None:
+            result, user_before = await asyncio.gather(progress_update, badge_update)
+        else:
+            result, user_before = await progress_update, None
         was_upserted = result.upserted_id is not None
         was_modified = result.modified_count > 0
+        owned = set(user_before.get("badges") or []) if user_before else set(earned)
         return {
             "success": True,
             "message": "Progreso actualizado"
@@ -398,6 +836,7 @@ async def update_progress(progress_data: Progress):
             else "No hubo cambios",
             "modified": was_modified,
             "created": was_upserted,
+            "new_badges": [b for b in earned if b not in owned],
         }
     except Exception as e:  # pylint: disable=broad-exception-caught
         http_500("Error al actualizar el progreso.", e)
@@ -534,9 +973,548 @@ async def get_primary_modules():
     return await get_modules_by_level("primaria")
 
 
+# ------------------------ CALCULADORAS (interés / ahorro) ------------
+# Motor vectorizado para simple_interest, compound_interest y
+# savings_challenge: una sola operación NumPy calcula todas las
+# combinaciones (capital x tasa x frecuencia x año). El cálculo y el JSON
+# se generan en un hilo (no bloquean el event loop) y se memoizan ya
+# serializados por entrada normalizada, con un tope de bytes en memoria.
+# Una grilla de clase (p. ej. 5 capitales x 10 tasas x 4 frecuencias x 30
+# años = 6.000 celdas) queda muy por debajo de CALC_MAX_CELLS.
+CALC_MAX_CELLS = int(os.environ.get("CALC_MAX_CELLS", "20000"))
+CALC_CACHE_BYTES = int(os.environ.get("CALC_CACHE_BYTES", str(32 * 1024 * 1024)))
+CALC_MAX_YEARS = 100
+CALC_MAX_WEEKS = 520
+CALC_MAX_RATE = 100.0  # % anual
+CALC_MAX_FREQUENCY = 365  # capitalización diaria
+
+
+def _norm_values(
+    values: List[float], name: str, positive: bool = False, maximum: Optional[float] = None
+) -> tuple:
+    """Redondea, quita duplicados y ordena: entradas equivalentes -> misma clave de caché."""
+    if not values:
+        raise HTTPException(status_code=400, detail=f"'{name}' no puede estar vacío")
+    normalized = tuple(sorted({round(float(v), 6) for v in values}))
+    if any(not math.isfinite(v) or v < 0 or (positive and v == 0) for v in normalized):
+        raise HTTPException(status_code=400, detail=f"Valores inválidos en '{name}'")
+    if maximum is not None and normalized[-1] > maximum:
+        raise HTTPException(status_code=400, detail=f"Los valores de '{name}' no pueden superar {maximum:g}")
+    return normalized
+
+
+def _check_finite(*tables) -> None:
+    """Montos enormes pueden desbordar a inf, que no se puede serializar en JSON."""
+    if not all(np.isfinite(table).all() for table in tables):
+        raise HTTPException(status_code=400, detail="Los montos son demasiado grandes para calcular")
+
+
+def _check_cells(*sizes: int) -> None:
+    if math.prod(sizes) > CALC_MAX_CELLS:
+        raise HTTPException(status_code=400, detail=f"Demasiadas combinaciones (máx. {CALC_MAX_CELLS})")
+
+
+def interest_tables(principals: tuple, rates: tuple, frequencies: tuple, years: int) -> Dict:
+    p = np.asarray(principals)[:, None, None, None]
+    r = np.asarray(rates)[None, :, None, None] / 100
+    f = np.asarray(frequencies)[None, None, :, None]
+    t = np.arange(years + 1)[None, None, None, :]
+
+    with np.errstate(over="ignore", invalid="ignore"):
+        compound = p * (1 + r / f) ** (f * t)  # (capital, tasa, frecuencia, año)
+        simple = p[:, :, 0, :] * (1 + r[:, :, 0, :] * t[:, :, 0, :])  # (capital, tasa, año)
+    _check_finite(compound, simple)
+    return {
+        "principals": list(principals),
+        "rates": list(rates),
+        "frequencies": list(frequencies),
+        "years": list(range(years + 1)),
+        "compound": np.round(compound, 2).tolist(),
+        "compound_interest": np.round(compound - p, 2).tolist(),
+        "simple": np.round(simple, 2).tolist(),
+        "simple_interest": np.round(simple - p[:, :, 0, :], 2).tolist(),
+    }
+
+
+def savings_tables(initial: float, deposits: tuple, rates: tuple, goals: tuple, weeks: int) -> Dict:
+    d = np.asarray(deposits)[:, None, None]
+    i = np.asarray(rates)[None, :, None] / 100 / 52  # tasa anual -> semanal
+    t = np.arange(weeks + 1)[None, None, :]
+
+    growth = (1 + i) ** t
+    # Anualidad: sum_{k<t} d(1+i)^k; con i = 0 se reduce a d * t
+    safe_i = np.where(i == 0, 1, i)
+    annuity = np.where(i == 0, t, (growth - 1) / safe_i)
+    with np.errstate(over="ignore", invalid="ignore"):
+        balance = initial * growth + d * annuity  # (depósito, tasa, semana)
+    _check_finite(balance)
+
+    # Primera semana en que el saldo alcanza cada meta; -1 si no la alcanza
+    g = np.asarray(goals)[:, None, None, None]
+    reached = balance[None, ...] >= g
+    first_week = np.where(reached.any(axis=-1), reached.argmax(axis=-1), -1)  # (meta, depósito, tasa)
+    return {
+        "initial": initial,
+        "deposits": list(deposits),
+        "rates": list(rates),
+        "goals": list(goals),
+        "weeks": list(range(weeks + 1)),
+        "balance": np.round(balance, 2).tolist(),
+        "weeks_to_goal": first_week.tolist(),
+    }
+
+
+calc_cache = _BytesLRU(max_bytes=CALC_CACHE_BYTES)
+
+
+def _tables_json(tables_fn, args: tuple) -> bytes:
+    return json.dumps(tables_fn(*args), separators=(",", ":")).encode("utf-8")
+
+
+async def calc_response(name: str, tables_fn, *args) -> Response:
+    """JSON de la tabla: memoria -> cálculo en un hilo. Pedidos iguales
+    simultáneos comparten un solo cálculo (single-flight)."""
+    key = repr((name, args))
+    data = calc_cache.get(key)
+    if data is None:
+
+        async def compute() -> bytes:
+            result = await run_in_threadpool(_tables_json, tables_fn, args)
+            calc_cache.put(key, result)
+            return result
+
+        data = await single_flight.do((f"calc_{name}", key), compute)
+    return Response(content=data, media_type="application/json")
+
+
+@api_router.post("/calc/interest")
+async def calc_interest(data: InterestCalc):
+    if not 1 <= data.years <= CALC_MAX_YEARS:
+        raise HTTPException(status_code=400, detail=f"years debe estar entre 1 y {CALC_MAX_YEARS}")
+    principals = _norm_values(data.principals, "principals")
+    rates = _norm_values(data.rates, "rates", maximum=CALC_MAX_RATE)
+    frequencies = tuple(sorted(set(data.frequencies)))
+    if not frequencies or min(frequencies) < 1 or max(frequencies) > CALC_MAX_FREQUENCY:
+        raise HTTPException(
+            status_code=400, detail=f"Los valores de 'frequencies' deben estar entre 1 y {CALC_MAX_FREQUENCY}"
+        )
+    _check_cells(len(principals), len(rates), len(frequencies), data.years + 1)
+    return await calc_response("interest", interest_tables, principals, rates, frequencies, data.years)
+
+
+@api_router.post("/calc/savings-plan")
+async def calc_savings_plan(data: SavingsPlanCalc):
+    if not 1 <= data.weeks <= CALC_MAX_WEEKS:
+        raise HTTPException(status_code=400, detail=f"weeks debe estar entre 1 y {CALC_MAX_WEEKS}")
+    if data.initial < 0 or not math.isfinite(data.initial):
+        raise HTTPException(status_code=400, detail="El monto inicial no puede ser negativo")
+    deposits = _norm_values(data.weekly_deposits, "weekly_deposits")
+    rates = _norm_values(data.rates, "rates", maximum=CALC_MAX_RATE)
+    goals = _norm_values(data.goals, "goals", positive=True) if data.goals else ()
+    _check_cells(max(1, len(goals)), len(deposits), len(rates), data.weeks + 1)
+    return await calc_response("savings", savings_tables, round(data.initial, 6), deposits, rates, goals, data.weeks)
+
+
+# ------------------------ BOLSA DE VALORES (stock_market) ------------
+# Simulador determinista por aula y día: las trayectorias de precios (GBM +
+# noticias programadas) salen de una semilla (aula, día), se generan una vez
+# y se comparten desde caché. Cada aula/día es una partida nueva con su
+# propio portafolio por alumno. Un tick avanza cada MARKET_TICK_SECONDS desde
+# que el aula abre el mercado ese día (POST /market/{aula}/open, con token);
+# las lecturas nunca lo abren.
+MARKET_TICKS = int(os.environ.get("MARKET_TICKS", "60"))
+MARKET_TICK_SECONDS = float(os.environ.get("MARKET_TICK_SECONDS", "30"))
+MARKET_START_CASH = 1000.0
+MARKET_NEWS_PER_DAY = 4
+MARKET_DT = 1 / 252  # cada tick simula un día hábil
+
+MARKET_ASSETS = [
+    {"symbol": "LIMON", "name": "Limonadas S.A.", "price": 20.0, "drift": 0.06, "volatility": 0.25},
+    {"symbol": "TECNO", "name": "TecnoKids", "price": 50.0, "drift": 0.12, "volatility": 0.45},
+    {"symbol": "ENERG", "name": "Energía Verde", "price": 35.0, "drift": 0.08, "volatility": 0.30},
+    {"symbol": "JUGUE", "name": "Juguetería Feliz", "price": 15.0, "drift": 0.05, "volatility": 0.35},
+    {"symbol": "BANCO", "name": "Banco Alcancía", "price": 40.0, "drift": 0.04, "volatility": 0.15},
+]
+MARKET_SYMBOLS = [a["symbol"] for a in MARKET_ASSETS]
+MARKET_SYMBOL_INDEX = {s: i for i, s in enumerate(MARKET_SYMBOLS)}
+
+# (titular, impacto en log-retorno)
+MARKET_NEWS_TEMPLATES = [
+    ("{name} lanza un producto que todos quieren", 0.08),
+    ("Sube la demanda de {name}", 0.05),
+    ("{name} tiene problemas en su fábrica", -0.10),
+    ("{name} recibe una multa", -0.06),
+    ("{name} anuncia ganancias récord", 0.10),
+    ("Clientes se quejan de {name}", -0.05),
+]
+
+# Cachés en memoria por (aula, día). Solo guardan el día de hoy: al cambiar
+# de día se vacían (ver _prune_market_caches), así no crecen sin límite.
+_market_opened: Dict[tuple, datetime] = {}
+_market_valuations: Dict[tuple, tuple] = {}
+_market_versions: Dict[tuple, int] = {}
+_market_cache_day: Optional[str] = None
+
+
+def _market_seed(classroom_id: str, day: str) -> int:
+    return int.from_bytes(hashlib.sha256(f"{classroom_id}|{day}".encode("utf-8")).digest()[:8], "little")
+
+
+@lru_cache(maxsize=256)
+def market_paths(classroom_id: str, day: str) -> tuple:
+    """(precios[tick, activo], noticias) para el aula y día. Solo lectura."""
+    rng = np.random.default_rng(_market_seed(classroom_id, day))
+    s0 = np.array([a["price"] for a in MARKET_ASSETS])
+    mu = np.array([a["drift"] for a in MARKET_ASSETS])
+    sigma = np.array([a["volatility"] for a in MARKET_ASSETS])
+
+    z = rng.standard_normal((MARKET_TICKS, len(MARKET_ASSETS)))
+    log_returns = (mu - sigma**2 / 2) * MARKET_DT + sigma * math.sqrt(MARKET_DT) * z
+
+    news = []
+    ticks = rng.choice(np.arange(1, MARKET_TICKS + 1), size=min(MARKET_NEWS_PER_DAY, MARKET_TICKS), replace=False)
+    for tick in sorted(int(t) for t in ticks):
+        asset = int(rng.integers(len(MARKET_ASSETS)))
+        headline, shock = MARKET_NEWS_TEMPLATES[int(rng.integers(len(MARKET_NEWS_TEMPLATES)))]
+        log_returns[tick - 1, asset] += shock
+        news.append(
+            {
+                "tick": tick,
+                "symbol": MARKET_SYMBOLS[asset],
+                "headline": headline.format(name=MARKET_ASSETS[asset]["name"]),
+            }
+        )
+
+    log_paths = np.vstack([np.zeros(len(MARKET_ASSETS)), np.cumsum(log_returns, axis=0)])
+    prices = np.round(s0 * np.exp(log_paths), 2)
+    prices.setflags(write=False)
+    return prices, tuple(news)
+
+
+def _market_today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def _market_day(day: Optional[str]) -> str:
+    today = _market_today()
+    if not day:
+        return today
+    try:
+        day = datetime.strptime(day, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError as e:
+        bad_request("Día inválido, usa AAAA-MM-DD", e)
+    # Un día futuro revelaría precios y noticias que aún no pasan
+    if day > today:
+        raise HTTPException(status_code=400, detail="No se puede consultar un día futuro")
+    return day
+
+
+def _prune_market_caches(today: str) -> None:
+    global _market_cache_day
+    if _market_cache_day == today:
+        return
+    for cache in (_market_opened, _market_valuations, _market_versions):
+        for key in [k for k in cache if k[1] != today]:
+            del cache[key]
+    _market_cache_day = today
+
+
+def _as_utc(ts: datetime) -> datetime:
+    return ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts
+
+
+async def market_opened_at(classroom_id: str, day: str) -> Optional[datetime]:
+    """Hora de apertura del mercado del aula ese día; None si nadie lo abrió. Solo lectura."""
+    key = (classroom_id, day)
+    opened_at = _market_opened.get(key)
+    if opened_at is None:
+        session = await db.market_sessions.find_one({"classroom_id": classroom_id, "day": day}, {"opened_at": 1})
+        if session is None:
+            return None
+        opened_at = _as_utc(session["opened_at"])
+        if day == _market_cache_day:
+            _market_opened[key] = opened_at
+    return opened_at
+
+
+async def market_tick(classroom_id: str, day: str) -> int:
+    """Tick actual. Hoy: 0 hasta que el aula abra el mercado (POST .../open).
+    Un día pasado ya terminó y se ve completo."""
+    today = _market_today()
+    if day != today:
+        return MARKET_TICKS
+    _prune_market_caches(today)
+    opened_at = await market_opened_at(classroom_id, day)
+    if opened_at is None:
+        return 0
+    elapsed = (datetime.now(timezone.utc) - opened_at).total_seconds()
+    return max(0, min(MARKET_TICKS, int(elapsed // MARKET_TICK_SECONDS)))
+
+
+def _portfolio_view(portfolio: Dict, prices_now) -> Dict:
+    holdings = {s: q for s, q in (portfolio.get("holdings") or {}).items() if q}
+    invested = sum(q * float(prices_now[MARKET_SYMBOL_INDEX[s]]) for s, q in holdings.items())
+    cash = portfolio.get("cash", MARKET_START_CASH)
+    return {
+        "user_id": portfolio["user_id"],
+        "cash": round(cash, 2),
+        "holdings": holdings,
+        "invested": round(invested, 2),
+        "total": round(cash + invested, 2),
+        "trades": len(portfolio.get("ledger") or []),
+    }
+
+
+async def _ensure_portfolio(classroom_id: str, day: str, user_id: str) -> Dict:
+    """Crea el portafolio si no existe. Solo desde el flujo de compra/venta (con token)."""
+    return await db.market_portfolios.find_one_and_update(
+        {"classroom_id": classroom_id, "day": day, "user_id": user_id},
+        {"$setOnInsert": {"cash": MARKET_START_CASH, "holdings": {}, "ledger": []}},
+        upsert=True,
+        return_document=True,
+    )
+
+
+@api_router.post("/market/{classroom_id}/open")
+async def open_market(classroom_id: str, token: Dict = Depends(current_token)):
+    """Abre el mercado de hoy del aula: desde aquí corren los ticks. Solo
+    la primera apertura del día cuenta; las siguientes devuelven la misma hora."""
+    day = _market_today()
+    _prune_market_caches(day)
+    try:
+        session = await db.market_sessions.find_one_and_update(
+            {"classroom_id": classroom_id, "day": day},
+            {"$setOnInsert": {"opened_at": datetime.now(timezone.utc), "opened_by": token["sub"]}},
+            upsert=True,
+            return_document=True,
+        )
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        http_500("No se pudo abrir el mercado", e)
+    opened_at = _as_utc(session["opened_at"])
+    _market_opened[(classroom_id, day)] = opened_at
+    return {"classroom_id": classroom_id, "day": day, "opened_at": opened_at.isoformat()}
+
+
+@api_router.get("/market/{classroom_id}")
+async def get_market(classroom_id: str, day: Optional[str] = None):
+    day = _market_day(day)
+    tick = await market_tick(classroom_id, day)
+    opened = day != _market_today() or await market_opened_at(classroom_id, day) is not None
+    prices, news = market_paths(classroom_id, day)
+    return {
+        "classroom_id": classroom_id,
+        "day": day,
+        "open": opened,
+        "tick": tick,
+        "total_ticks": MARKET_TICKS,
+        "tick_seconds": MARKET_TICK_SECONDS,
+        "assets": [{"symbol": a["symbol"], "name": a["name"]} for a in MARKET_ASSETS],
+        # historial hasta el tick actual (el futuro no se revela)
+        "prices": prices[: tick + 1].tolist(),
+        "news": [n for n in news if n["tick"] <= tick],
+    }
+
+
+@api_router.post("/market/{classroom_id}/trade")
+async def market_trade(classroom_id: str, data: MarketTrade, token: Dict = Depends(current_token)):
+    token_user_id(token, data.user_id)
+    if data.symbol not in MARKET_SYMBOL_INDEX:
+        raise HTTPException(status_code=400, detail=f"Acción desconocida: {data.symbol}")
+    if data.side not in ("buy", "sell"):
+        raise HTTPException(status_code=400, detail="side debe ser 'buy' o 'sell'")
+    if data.quantity <= 0:
+        raise HTTPException(status_code=400, detail="La cantidad debe ser positiva")
+
+    day = _market_day(None)
+    tick = await market_tick(classroom_id, day)
+    if await market_opened_at(classroom_id, day) is None:
+        raise HTTPException(status_code=400, detail="El mercado de hoy aún no abre")
+    if tick >= MARKET_TICKS:
+        raise HTTPException(status_code=400, detail="El mercado de hoy ya cerró")
+    prices, _ = market_paths(classroom_id, day)
+    price = float(prices[tick, MARKET_SYMBOL_INDEX[data.symbol]])
+    amount = round(price * data.quantity, 2)
+
+    await _ensure_portfolio(classroom_id, day, data.user_id)
+    query: Dict = {"classroom_id": classroom_id, "day": day, "user_id": data.user_id}
+    if data.side == "buy":
+        query["cash"] = {"$gte": amount}
+        cash_delta, qty_delta = -amount, data.quantity
+    else:
+        query[f"holdings.{data.symbol}"] = {"$gte": data.quantity}
+        cash_delta, qty_delta = amount, -data.quantity
+
+    portfolio = await db.market_portfolios.find_one_and_update(
+        query,
+        {
+            "$inc": {"cash": cash_delta, f"holdings.{data.symbol}": qty_delta},
+            "$push": {
+                "ledger": {
+                    "tick": tick,
+                    "symbol": data.symbol,
+                    "side": data.side,
+                    "quantity": data.quantity,
+                    "price": price,
+                    "at": datetime.now(timezone.utc),
+                }
+            },
+        },
+        return_document=True,
+    )
+    if not portfolio:
+        detail = "No tienes suficiente dinero" if data.side == "buy" else "No tienes suficientes acciones"
+        raise HTTPException(status_code=400, detail=detail)
+
+    key = (classroom_id, day)
+    _market_versions[key] = _market_versions.get(key, 0) + 1
+    return {"success": True, "tick": tick, "price": price, "portfolio": _portfolio_view(portfolio, prices[tick])}
+
+
+@api_router.get("/market/{classroom_id}/portfolio/{user_id}")
+async def get_market_portfolio(classroom_id: str, user_id: str):
+    day = _market_day(None)
+    tick = await market_tick(classroom_id, day)
+    prices, _ = market_paths(classroom_id, day)
+    # Solo lectura: consultar no crea portafolios (no aparecerían en el ranking)
+    portfolio = await db.market_portfolios.find_one({"classroom_id": classroom_id, "day": day, "user_id": user_id})
+    if portfolio is None:
+        portfolio = {"user_id": user_id, "cash": MARKET_START_CASH, "holdings": {}, "ledger": []}
+    return {"tick": tick, **_portfolio_view(portfolio, prices[tick]), "ledger": portfolio.get("ledger", [])}
+
+
+@api_router.get("/market/{classroom_id}/valuations")
+async def get_market_valuations(classroom_id: str, day: Optional[str] = None):
+    """Ranking del aula: todos los portafolios valorados en una sola operación
+    (efectivo + tenencias @ precios del tick), cacheada por tick."""
+    day = _market_day(day)
+    tick = await market_tick(classroom_id, day)
+    key = (classroom_id, day)
+    version = _market_versions.get(key, 0)
+    cached = _market_valuations.get(key)
+    if cached and cached[0] == tick and cached[1] == version:
+        return cached[2]
+
+    prices, _ = market_paths(classroom_id, day)
+    portfolios = await db.market_portfolios.find(
+        {"classroom_id": classroom_id, "day": day}, {"user_id": 1, "cash": 1, "holdings": 1}
+    ).to_list(length=None)
+
+    holdings = np.zeros((len(portfolios), len(MARKET_ASSETS)))
+    cash = np.zeros(len(portfolios))
+    for row, p in enumerate(portfolios):
+        cash[row] = p.get("cash", MARKET_START_CASH)
+        for symbol, qty in (p.get("holdings") or {}).items():
+            if symbol in MARKET_SYMBOL_INDEX:
+                holdings[row, MARKET_SYMBOL_INDEX[symbol]] = qty
+    totals = cash + holdings @ prices[tick]
+
+    order = np.argsort(-totals, kind="stable")
+    result = {
+        "classroom_id": classroom_id,
+        "day": day,
+        "tick": tick,
+        "ranking": [
+            {"user_id": portfolios[i]["user_id"], "cash": round(float(cash[i]), 2), "total": round(float(totals[i]), 2)}
+            for i in order
+        ],
+    }
+    if day == _market_cache_day:
+        _market_valuations[key] = (tick, version, result)
+    return result
+
+
+# ------------------------ CLASSROOM (alta masiva) --------------------
+# Un docente registra toda la lista de una vez: un insert_many (ordered=False)
+# en users y otro en progress, con el nivel ya elegido. Los usernames
+# repetidos se informan por fila en vez de abortar el lote.
+BULK_MAX_STUDENTS = int(os.environ.get("BULK_MAX_STUDENTS", "200"))
+
+
+@api_router.post("/classroom/{classroom_id}/students/bulk", dependencies=[Depends(require_admin)])
+async def bulk_register_students(classroom_id: str, data: BulkStudents):
+    if not data.students:
+        raise HTTPException(status_code=400, detail="La lista de alumnos está vacía")
+    if len(data.students) > BULK_MAX_STUDENTS:
+        raise HTTPException(status_code=400, detail=f"Máximo {BULK_MAX_STUDENTS} alumnos por solicitud")
+    if data.selected_level not in ALLOWED_LEVELS:
+        raise HTTPException(status_code=400, detail="Nivel no válido")
+
+    # Sin el índice único, insert_many no detecta nombres ya usados: se
+    # consultan antes (igual que register)
+    existing = set()
+    if not _username_index_ready.is_set():
+        names = list({s.username for s in data.students if s.username.strip()})
+        try:
+            found = await db.users.find({"username": {"$in": names}}, {"username": 1}).to_list(length=None)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            http_500("Error al verificar los nombres de usuario", e)
+        existing = {u["username"] for u in found}
+
+    now = datetime.now(timezone.utc)
+    conflicts: List[Dict] = []
+    rows: List[int] = []
+    docs: List[Dict] = []
+    seen = set()
+    for row, student in enumerate(data.students):
+        if not student.username.strip():
+            conflicts.append({"row": row, "username": student.username, "reason": "Nombre de usuario requerido"})
+            continue
+        if student.username in seen:
+            conflicts.append({"row": row, "username": student.username, "reason": "Repetido en la lista"})
+            continue
+        seen.add(student.username)
+        if student.username in existing:
+            conflicts.append({"row": row, "username": student.username, "reason": "Usuario ya existe"})
+            continue
+        doc = new_user_doc(student.username, student.age, student.avatar_config, data.selected_level, now)
+        doc.update(classroom_id=classroom_id)
+        rows.append(row)
+        docs.append(doc)
+
+    # insert_many asigna _id a cada doc antes de enviar: no hace falta releer
+    failed: Dict[int, str] = {}
+    if docs:
+        try:
+            await db.users.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for err in e.details.get("writeErrors", []):
+                failed[err["index"]] = "Usuario ya existe" if err.get("code") == 11000 else err.get("errmsg", "Error")
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            http_500("Error al registrar los alumnos", e)
+
+    created_docs = []
+    for index, (row, doc) in enumerate(zip(rows, docs)):
+        if index in failed:
+            conflicts.append({"row": row, "username": doc["username"], "reason": failed[index]})
+        else:
+            created_docs.append((row, doc))
+            username_bloom.add(doc["username"])
+
+    if created_docs:
+        progress_docs = [Progress(user_id=str(doc["_id"]), updated_at=now).dict() for _, doc in created_docs]
+        try:
+            await db.progress.insert_many(progress_docs, ordered=False)
+        except BulkWriteError as e:
+            # get_progress crea el progreso faltante bajo demanda; no se pierde el alta
+            logger.warning("Alta masiva %s: %s progresos no insertados", classroom_id, len(e.details.get("writeErrors", [])))
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # Los usuarios ya existen: un 500 aquí haría reintentar y chocar con sus propios nombres
+            logger.warning("Alta masiva %s: progresos no insertados (%s)", classroom_id, e)
+
+    logger.info("Alta masiva en aula %s: %s creados, %s conflictos", classroom_id, len(created_docs), len(conflicts))
+    return {
+        "success": True,
+        "classroom_id": classroom_id,
+        "created_count": len(created_docs),
+        "created": [{"row": row, **user_dict_to_response(doc).dict()} for row, doc in created_docs],
+        "conflicts": sorted(conflicts, key=lambda c: c["row"]),
+    }
+
+
 # ------------------------ GAME ---------------------------------------
 @api_router.post("/game/lemonade")
-async def save_lemonade_game(game: LemonadeGameState):
+async def save_lemonade_game(game: LemonadeGameState, token: Dict = Depends(current_token)):
+    token_user_id(token, game.user_id)
     try:
         await db.lemonade_games.update_one(
             {"user_id": game.user_id},
@@ -556,38 +1534,159 @@ async def get_lemonade_game(user_id: str):
     if not user_id:
         raise HTTPException(status_code=400, detail="ID de usuario requerido")
     try:
-        game = await db.lemonade_games.find_one({"user_id": user_id})
+        game = await single_flight.do(
+            ("get_lemonade_game", user_id), lambda: db.lemonade_games.find_one({"user_id": user_id})
+        )
         return game if game else None
     except Exception as e:  # pylint: disable=broad-exception-caught
         http_500("Error al obtener el estado del juego.", e)
 
 
-# ------------------------ COINS & BADGES -----------------------------
-@api_router.post("/coins/add")
-async def add_coins(data: CoinUpdate):
+# ------------------------ HISTORIAL DE PARTIDAS ----------------------
+# Cada intento terminado de cualquier minijuego se agrega a un documento
+# "bucket" por usuario y mes (máx. HISTORY_BUCKET_SIZE sesiones por bucket).
+# Así el número de documentos crece por meses, no por partidas, y las
+# últimas sesiones se leen en una sola consulta indexada.
+HISTORY_BUCKET_SIZE = int(os.environ.get("HISTORY_BUCKET_SIZE", "200"))
+HISTORY_MAX_PAGE = 100
+
+
+def _history_month(ts: datetime) -> str:
+    return ts.strftime("%Y-%m")
+
+
+def encode_history_cursor(finished_at: datetime, session_id: str) -> str:
+    raw = f"{finished_at.isoformat()}|{session_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_history_cursor(cursor: str) -> tuple:
     try:
-        obj_id = ObjectId(data.user_id)
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        ts, session_id = raw.split("|", 1)
+        return datetime.fromisoformat(ts), session_id
     except Exception as e:  # pylint: disable=broad-exception-caught
-        bad_request("ID de usuario inválido", e)
+        bad_request("Cursor inválido", e)
+
+
+@api_router.post("/history")
+async def record_game_session(session: GameSession, token: Dict = Depends(current_token)):
+    token_user_id(token, session.user_id)
+    if not session.module:
+        raise HTTPException(status_code=400, detail="Módulo requerido")
+
+    finished_at = session.finished_at
+    if finished_at.tzinfo is not None:
+        finished_at = finished_at.astimezone(timezone.utc).replace(tzinfo=None)
+    entry = session.dict(exclude={"user_id"})
+    entry.update(id=str(ObjectId()), finished_at=finished_at)
+    try:
+        await db.game_history.update_one(
+            {"user_id": session.user_id, "month": _history_month(finished_at), "count": {"$lt": HISTORY_BUCKET_SIZE}},
+            {
+                "$push": {"sessions": entry},
+                "$inc": {"count": 1},
+                "$min": {"first_at": finished_at},
+                "$max": {"last_at": finished_at},
+            },
+            upsert=True,
+        )
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        http_500("Error al guardar la partida.", e)
+    return {"success": True, "id": entry["id"]}
+
+
+@api_router.get("/history/{user_id}")
+async def get_game_history(
+    user_id: str,
+    module: Optional[str] = None,
+    since: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = 20,
+):
+    if not user_id:
+        raise HTTPException(status_code=400, detail="ID de usuario requerido")
+    limit = max(1, min(limit, HISTORY_MAX_PAGE))
+    if since is not None and since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+
+    # Poda a nivel de bucket (índice user_id + last_at) y luego a nivel de sesión
+    bucket_match: Dict = {"user_id": user_id}
+    if since is not None:
+        bucket_match["last_at"] = {"$gte": since}
+    if module:
+        bucket_match["sessions.module"] = module
+    cursor_key = None
+    if cursor:
+        cursor_key = decode_history_cursor(cursor)
+        bucket_match["first_at"] = {"$lte": cursor_key[0]}
+
+    def wanted(entry: Dict) -> bool:
+        if module and entry.get("module") != module:
+            return False
+        if since is not None and entry["finished_at"] < since:
+            return False
+        return cursor_key is None or (entry["finished_at"], entry["id"]) < cursor_key
+
+    # Se recorren los buckets del más reciente al más antiguo y se para en
+    # cuanto ningún bucket restante puede tener sesiones más nuevas que las
+    # limit + 1 ya reunidas: cada página cuesta unos pocos buckets, no todo
+    # el historial del usuario.
+    page_size = limit + 1
+    batch = page_size // HISTORY_BUCKET_SIZE + 2
+    sessions: List[Dict] = []
+    buckets = (
+        db.game_history.find(bucket_match, {"_id": 0, "sessions": 1, "last_at": 1})
+        .sort("last_at", -1)
+        .batch_size(batch)
+    )
+    try:
+        async for bucket in buckets:
+            if len(sessions) == page_size and bucket["last_at"] < sessions[-1]["finished_at"]:
+                break
+            sessions.extend(entry for entry in bucket.get("sessions", []) if wanted(entry))
+            sessions.sort(key=lambda entry: (entry["finished_at"], entry["id"]), reverse=True)
+            del sessions[page_size:]
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        http_500("Error al obtener el historial.", e)
+    finally:
+        await buckets.close()
+
+    next_cursor = None
+    if len(sessions) > limit:
+        sessions = sessions[:limit]
+        last = sessions[-1]
+        next_cursor = encode_history_cursor(last["finished_at"], last["id"])
+    return {"sessions": sessions, "next_cursor": next_cursor}
+
+
+# ------------------------ COINS & BADGES -----------------------------
+@api_router.post("/coins/add")
+async def add_coins(data: CoinUpdate, token: Dict = Depends(current_token)):
+    obj_id = token_user_id(token, data.user_id)
 
     if data.coins == 0:
         raise HTTPException(status_code=400, detail="La cantidad de monedas debe ser distinta de cero")
 
-    result = await db.users.update_one({"_id": obj_id}, {"$inc": {"coins": data.coins}})
-    if result.matched_count == 0:
+    pipeline = [{"$set": {"coins": {"$add": [{"$ifNull": ["$coins", 0]}, data.coins]}}}]
+    badge_stage = badge_pipeline_stage("add_coins")
+    if badge_stage:
+        pipeline.append(badge_stage)
+
+    user_before = await db.users.find_one_and_update(
+        {"_id": obj_id}, pipeline, projection={"coins": 1, "badges": 1}, return_document=False
+    )
+    if not user_before:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
-    user = await db.users.find_one({"_id": obj_id}, {"coins": 1})
-    new_total = user.get("coins", 0) if user else 0
-    return {"success": True, "new_total": new_total}
+    new_total = user_before.get("coins", 0) + data.coins
+    new_badges = new_badges_after("add_coins", user_before, {"coins": new_total})
+    return {"success": True, "new_total": new_total, "new_badges": new_badges}
 
 
 @api_router.post("/badges/unlock")
-async def unlock_badge(data: BadgeUnlock):
-    try:
-        obj_id = ObjectId(data.user_id)
-    except Exception as e:  # pylint: disable=broad-exception-caught
-        bad_request("ID de usuario inválido", e)
+async def unlock_badge(data: BadgeUnlock, token: Dict = Depends(current_token)):
+    obj_id = token_user_id(token, data.user_id)
 
     if not data.badge_id:
         raise HTTPException(status_code=400, detail="ID de insignia requerido")
@@ -627,61 +1726,69 @@ async def get_shop_items():
 
 
 @api_router.post("/shop/purchase")
-async def purchase_item(data: PurchaseItem):
-    try:
-        obj_id = ObjectId(data.user_id)
-    except Exception as e:  # pylint: disable=broad-exception-caught
-        bad_request("ID de usuario inválido", e)
+async def purchase_item(data: PurchaseItem, token: Dict = Depends(current_token)):
+    obj_id = token_user_id(token, data.user_id)
 
     if not data.item_id:
         raise HTTPException(status_code=400, detail="ID de artículo requerido")
     if data.price < 0:
         raise HTTPException(status_code=400, detail="El precio no puede ser negativo")
 
+    pipeline = [
+        {
+            "$set": {
+                "coins": {"$subtract": ["$coins", data.price]},
+                "purchased_items": {
+                    "$concatArrays": [{"$ifNull": ["$purchased_items", []]}, [{"$literal": data.item_id}]]
+                },
+            }
+        }
+    ]
+    badge_stage = badge_pipeline_stage("purchase_item")
+    if badge_stage:
+        pipeline.append(badge_stage)
+
     user = await db.users.find_one_and_update(
         {"_id": obj_id, "coins": {"$gte": data.price}, "purchased_items": {"$ne": data.item_id}},
-        {"$inc": {"coins": -data.price}, "$push": {"purchased_items": data.item_id}},
-        projection={"coins": 1},
-        return_document=True,
+        pipeline,
+        projection={"coins": 1, "purchased_items": 1, "badges": 1},
+        return_document=False,
     )
     if not user:
+        # El usuario existe (token válido): solo falta saber qué condición falló
         try:
             check_user = await db.users.find_one({"_id": obj_id}, {"coins": 1, "purchased_items": 1})
         except Exception as e:  # pylint: disable=broad-exception-caught
             http_500("Error al consultar usuario para compra", e)
 
-        if not check_user:
-            raise HTTPException(status_code=404, detail="Usuario no encontrado")
+        check_user = check_user or {}
         if check_user.get("coins", 0) < data.price:
             raise HTTPException(status_code=400, detail="No tienes suficientes monedas")
         if data.item_id in check_user.get("purchased_items", []):
             raise HTTPException(status_code=400, detail="Ya compraste este artículo")
         raise HTTPException(status_code=500, detail="No se pudo completar la compra")
 
-    return {"success": True, "new_coins": user.get("coins", 0)}
+    new_coins = user.get("coins", 0) - data.price
+    purchased = (user.get("purchased_items") or []) + [data.item_id]
+    new_badges = new_badges_after("purchase_item", user, {"coins": new_coins, "purchased_items": purchased})
+    return {"success": True, "new_coins": new_coins, "new_badges": new_badges}
 
 
 @api_router.post("/shop/equip")
-async def equip_item(data: EquipItem):
-    try:
-        obj_id = ObjectId(data.user_id)
-    except Exception as e:  # pylint: disable=broad-exception-caught
-        bad_request("ID de usuario inválido", e)
+async def equip_item(data: EquipItem, token: Dict = Depends(current_token)):
+    obj_id = token_user_id(token, data.user_id)
 
     cat_en = normalize_cat_to_en(data.category)
     if not cat_en or cat_en not in CAT_EN_TO_ES:
         raise HTTPException(status_code=400, detail=f"Categoría inválida: {data.category}")
 
     cat_es = CAT_EN_TO_ES[cat_en]
+    update_filter: Dict = {"_id": obj_id}
     update_operation: Dict[str, Dict] = {}
 
     if data.item_id:
-        user = await db.users.find_one({"_id": obj_id, "purchased_items": data.item_id}, {"_id": 1})
-        if not user:
-            check_user = await db.users.find_one({"_id": obj_id}, {"purchased_items": 1})
-            if not check_user:
-                raise HTTPException(status_code=404, detail="Usuario no encontrado")
-            raise HTTPException(status_code=400, detail="No has comprado este artículo")
+        # La compra se valida en el mismo update; con token válido, no coincidir = no comprado
+        update_filter["purchased_items"] = data.item_id
         update_operation["$set"] = {
             f"equipped_items.{cat_en}": data.item_id,
             f"equipped_items.{cat_es}": data.item_id,
@@ -692,30 +1799,256 @@ async def equip_item(data: EquipItem):
             f"equipped_items.{cat_es}": "",
         }
 
-    result = await db.users.update_one({"_id": obj_id}, update_operation)
-    if result.matched_count == 0:
+    updated_user = await db.users.find_one_and_update(
+        update_filter, update_operation, projection={"equipped_items": 1}, return_document=True
+    )
+    if not updated_user:
+        if data.item_id:
+            raise HTTPException(status_code=400, detail="No has comprado este artículo")
         raise HTTPException(status_code=404, detail="Usuario no encontrado al intentar equipar")
 
-    updated_user = await db.users.find_one({"_id": obj_id}, {"equipped_items": 1})
-    equipped_items = updated_user.get("equipped_items", {}) if updated_user else {}
+    equipped_items = updated_user.get("equipped_items", {})
     return {"success": True, "equipped_items": equipped_items}
 
 
-# ------------------------ XP & LEVEL ---------------------------------
-@api_router.post("/xp/add")
-async def add_xp(data: AddXP):
+# ------------------------ AVATAR (render en servidor) ----------------
+# Compone las capas del avatar (fondo, base, sombrero, accesorio, especial)
+# igual que frontend/components/AvatarCanvas.tsx. Cada combinación se
+# renderiza una sola vez: la clave es un hash del conjunto equipado + tamaño
+# y el PNG queda en un LRU en memoria y en disco.
+AVATAR_ASSETS_DIR = Path(os.environ.get("AVATAR_ASSETS_DIR", ROOT_DIR.parent / "frontend" / "assets" / "avatar"))
+AVATAR_CACHE_DIR = Path(os.environ.get("AVATAR_CACHE_DIR", ROOT_DIR / ".cache" / "avatars"))
+AVATAR_MEM_CACHE_SIZE = int(os.environ.get("AVATAR_MEM_CACHE_SIZE", "256"))
+AVATAR_SIZES = (80, 160, 320, 640, 980)
+AVATAR_DEFAULT_SIZE = 320
+
+# Lienzo y cajas en coordenadas del canvas base (320x200), mismas que LAYOUT del frontend
+AVATAR_CANVAS = (320, 200)
+AVATAR_SLOTS = {
+    "background": {"box": (0, 0, 320, 200), "fit": "cover"},
+    "base": {"box": (110, 34, 100, 100), "fit": "contain"},
+    "hat": {"box": (120, -2, 90, 70), "fit": "contain"},
+    "accessory": {"box": (144, 68, 52, 22), "fit": "contain"},
+    "special": {"box": (210, 95, 40, 40), "fit": "contain"},
+}
+AVATAR_LAYER_ORDER = ("background", "base", "hat", "accessory", "special")
+
+AVATAR_BASE_FILES = {
+    "niño": "base_nino.png",
+    "niña": "base_nina.png",
+}
+GENDER_ALIASES = {"male": "niño", "nino": "niño", "female": "niña", "nina": "niña"}
+
+# ids de tienda y alias del frontend (kebab-case) -> PNG en assets/avatar
+AVATAR_ITEM_FILES = {
+    "hat_cap": "gorra_cool.png",
+    "gorra-cool": "gorra_cool.png",
+    "hat_crown": "corona_real.png",
+    "corona-real": "corona_real.png",
+    "hat_wizard": "sombrero_mago.png",
+    "sombrero-mago": "sombrero_mago.png",
+    "acc_glasses": "lentes_cool.png",
+    "lentes-cool": "lentes_cool.png",
+    "acc_medal": "medalla.png",
+    "medalla": "medalla.png",
+    "bg_sunset": "fondos/atardecer.png",
+    "atardecer": "fondos/atardecer.png",
+    "bg_forest": "fondos/bosque.png",
+    "bosque": "fondos/bosque.png",
+}
+AVATAR_DEFAULT_BACKGROUND = "fondos/atardecer.png"
+
+
+avatar_mem_cache = _BytesLRU(AVATAR_MEM_CACHE_SIZE)
+_avatar_layer_cache: Dict[str, Image.Image] = {}
+
+
+def _norm_item_id(item_id) -> str:
+    if not item_id:
+        return ""
+    return "-".join(str(item_id).strip().lower().split())
+
+
+def resolve_avatar_layers(equipped: Dict, gender: Optional[str] = None) -> Dict[str, str]:
+    """equipped_items (es/en) + género -> {slot: archivo}. Ignora ids sin PNG."""
+    equipped = equipped if isinstance(equipped, dict) else {}
+    g = (gender or "niño").strip().lower()
+    g = GENDER_ALIASES.get(g, g)
+    layers = {"base": AVATAR_BASE_FILES.get(g, AVATAR_BASE_FILES["niño"])}
+
+    for slot in ("background", "hat", "accessory", "special"):
+        item_id = equipped.get(slot) or equipped.get(CAT_EN_TO_ES[slot])
+        filename = AVATAR_ITEM_FILES.get(_norm_item_id(item_id))
+        if filename:
+            layers[slot] = filename
+    layers.setdefault("background", AVATAR_DEFAULT_BACKGROUND)
+    return layers
+
+
+def avatar_cache_key(layers: Dict[str, str], size: int) -> str:
+    canonical = json.dumps({"layers": layers, "size": size}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+def _load_avatar_layer(filename: str) -> Image.Image:
+    img = _avatar_layer_cache.get(filename)
+    if img is None:
+        with Image.open(AVATAR_ASSETS_DIR / filename) as src:
+            img = src.convert("RGBA")
+        _avatar_layer_cache[filename] = img
+    return img
+
+
+def render_avatar_png(layers: Dict[str, str], size: int) -> bytes:
+    """Compone las capas y devuelve el PNG. Bloqueante: llamar vía threadpool."""
+    k = size / AVATAR_CANVAS[0]
+    canvas = Image.new("RGBA", (size, round(AVATAR_CANVAS[1] * k)), (0, 0, 0, 0))
+
+    for slot in AVATAR_LAYER_ORDER:
+        filename = layers.get(slot)
+        if not filename:
+            continue
+        left, top, width, height = AVATAR_SLOTS[slot]["box"]
+        box_size = (max(1, round(width * k)), max(1, round(height * k)))
+        layer = _load_avatar_layer(filename)
+        if AVATAR_SLOTS[slot]["fit"] == "cover":
+            layer = ImageOps.fit(layer, box_size, Image.LANCZOS)
+        else:
+            layer = ImageOps.contain(layer, box_size, Image.LANCZOS)
+        # centrar dentro de la caja, como resizeMode="contain"
+        x = round(left * k) + (box_size[0] - layer.width) // 2
+        y = round(top * k) + (box_size[1] - layer.height) // 2
+        canvas.alpha_composite(layer, (max(0, x), max(0, y)))
+
+    out = io.BytesIO()
+    canvas.save(out, format="PNG", optimize=True)
+    return out.getvalue()
+
+
+def _read_avatar_disk(key: str) -> Optional[bytes]:
+    path = AVATAR_CACHE_DIR / f"{key}.png"
+    try:
+        return path.read_bytes()
+    except FileNotFoundError:
+        return None
+
+
+def _write_avatar_disk(key: str, data: bytes) -> None:
+    AVATAR_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = AVATAR_CACHE_DIR / f".{key}.{os.getpid()}.tmp"
+    tmp.write_bytes(data)
+    os.replace(tmp, AVATAR_CACHE_DIR / f"{key}.png")
+
+
+async def _load_or_render_avatar(key: str, layers: Dict[str, str], size: int) -> bytes:
+    data = await run_in_threadpool(_read_avatar_disk, key)
+    if data is None:
+        data = await run_in_threadpool(render_avatar_png, layers, size)
+        try:
+            await run_in_threadpool(_write_avatar_disk, key, data)
+        except OSError as e:
+            logger.warning("No se pudo guardar avatar %s en disco: %s", key, e)
+    avatar_mem_cache.put(key, data)
+    return data
+
+
+async def get_avatar_png(key: str, layers: Dict[str, str], size: int) -> bytes:
+    """PNG de la clave usando memoria -> disco -> render. Fallos simultáneos de
+    la misma clave comparten un solo render (single-flight)."""
+    data = avatar_mem_cache.get(key)
+    if data is not None:
+        return data
+    try:
+        return await single_flight.do(("avatar_render", key), lambda: _load_or_render_avatar(key, layers, size))
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        http_500("Error al generar la imagen del avatar", e)
+
+
+def _check_avatar_size(size: int) -> None:
+    if size not in AVATAR_SIZES:
+        raise HTTPException(status_code=400, detail=f"Tamaño no válido, usa uno de {list(AVATAR_SIZES)}")
+
+
+@api_router.get("/avatar/render.png")
+async def render_avatar_by_config(
+    request: Request,
+    size: int = AVATAR_DEFAULT_SIZE,
+    gender: Optional[str] = None,
+    hat: Optional[str] = None,
+    accessory: Optional[str] = None,
+    background: Optional[str] = None,
+    special: Optional[str] = None,
+):
+    _check_avatar_size(size)
+    layers = resolve_avatar_layers(
+        {"hat": hat, "accessory": accessory, "background": background, "special": special}, gender
+    )
+    key = avatar_cache_key(layers, size)
+    etag = f'"{key}"'
+    # La URL determina el contenido: se puede cachear para siempre
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    data = await get_avatar_png(key, layers, size)
+    return Response(content=data, media_type="image/png", headers=headers)
+
+
+@api_router.get("/avatar/{user_id}.png")
+async def render_avatar_by_user(user_id: str, request: Request, size: int = AVATAR_DEFAULT_SIZE):
+    _check_avatar_size(size)
     try:
-        obj_id = ObjectId(data.user_id)
+        obj_id = ObjectId(user_id)
     except Exception as e:  # pylint: disable=broad-exception-caught
         bad_request("ID de usuario inválido", e)
 
+    user = await db.users.find_one({"_id": obj_id}, {"equipped_items": 1, "avatar_config": 1, "gender": 1})
+    if not user:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+
+    avatar_config = user.get("avatar_config") or {}
+    gender = user.get("gender") or (avatar_config.get("gender") if isinstance(avatar_config, dict) else None)
+    layers = resolve_avatar_layers(user.get("equipped_items", {}), gender)
+    key = avatar_cache_key(layers, size)
+    etag = f'"{key}"'
+    # El atuendo del usuario puede cambiar: revalidar con ETag (el hash del conjunto)
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=60, must-revalidate"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    data = await get_avatar_png(key, layers, size)
+    return Response(content=data, media_type="image/png", headers=headers)
+
+
+# ------------------------ XP & LEVEL ---------------------------------
+@api_router.post("/xp/add")
+async def add_xp(data: AddXP, token: Dict = Depends(current_token)):
+    obj_id = token_user_id(token, data.user_id)
+
     if data.xp <= 0:
         raise HTTPException(status_code=400, detail="La cantidad de XP debe ser positiva")
 
+    # xp, bonus de subida de nivel e insignias en un solo update (pipeline)
+    old_xp_expr = {"$ifNull": ["$xp", 0]}
+    new_xp_expr = {"$add": [old_xp_expr, data.xp]}
+
+    def level_expr(xp_expr):
+        return {"$max": [1, {"$add": [{"$floor": {"$divide": [xp_expr, 100]}}, 1]}]}
+
+    bonus_expr = {
+        "$cond": [
+            {"$gt": [level_expr(new_xp_expr), level_expr(old_xp_expr)]},
+            {"$multiply": [level_expr(new_xp_expr), 10]},
+            0,
+        ]
+    }
+    pipeline = [{"$set": {"xp": new_xp_expr, "coins": {"$add": [{"$ifNull": ["$coins", 0]}, bonus_expr]}}}]
+    badge_stage = badge_pipeline_stage("add_xp")
+    if badge_stage:
+        pipeline.append(badge_stage)
+
     user_before_update = await db.users.find_one_and_update(
         {"_id": obj_id},
-        {"$inc": {"xp": data.xp}},
-        projection={"xp": 1, "coins": 1},
+        pipeline,
+        projection={"xp": 1, "coins": 1, "badges": 1},
         return_document=False,
     )
     if not user_before_update:
@@ -727,15 +2060,9 @@ async def add_xp(data: AddXP):
     new_level = calculate_level_from_xp(new_xp)
 
     level_up = new_level > old_level
-    bonus_coins = 0
-    if level_up:
-        bonus_coins = new_level * 10
-        await db.users.update_one({"_id": obj_id}, {"$inc": {"coins": bonus_coins}})
-
-    user_after_update = await db.users.find_one({"_id": obj_id}, {"coins": 1})
-    final_coins = (
-        user_after_update.get("coins", 0) if user_after_update else user_before_update.get("coins", 0) + bonus_coins
-    )
+    bonus_coins = new_level * 10 if level_up else 0
+    final_coins = user_before_update.get("coins", 0) + bonus_coins
+    new_badges = new_badges_after("add_xp", user_before_update, {"xp": new_xp, "coins": final_coins})
 
     return {
         "success": True,
@@ -744,7 +2071,373 @@ async def add_xp(data: AddXP):
         "level_up": level_up,
         "bonus_coins": bonus_coins,
         "total_coins": final_coins,
+        "new_badges": new_badges,
+    }
+
+
+# ------------------------ ASSETS (manifest + estáticos) --------------
+# Sirve frontend/assets con URLs con hash de contenido. El cliente descarga
+# el manifest, compara hashes y solo baja lo que cambió. Las URLs con hash
+# son inmutables; audio/video soportan Range para empezar a reproducir antes
+# de tener el archivo completo.
+STATIC_ASSETS_DIR = Path(os.environ.get("STATIC_ASSETS_DIR", ROOT_DIR.parent / "frontend" / "assets"))
+ASSETS_CACHE_DIR = Path(os.environ.get("ASSETS_CACHE_DIR", ROOT_DIR / ".cache" / "assets"))
+ASSETS_RESCAN_SECONDS = float(os.environ.get("ASSETS_RESCAN_SECONDS", "30"))
+ASSETS_CHUNK_SIZE = 256 * 1024
+# Tipos que vale la pena precomprimir (png/mp3/mp4 ya vienen comprimidos)
+ASSETS_COMPRESSIBLE = {".wav", ".ttf", ".otf", ".json", ".svg", ".txt", ".js", ".css", ".html"}
+ASSETS_MIN_GZIP_SIZE = 1024
+
+mimetypes.add_type("audio/mpeg", ".mp3")
+mimetypes.add_type("audio/wav", ".wav")
+mimetypes.add_type("video/mp4", ".mp4")
+mimetypes.add_type("font/ttf", ".ttf")
+
+_assets_state: Dict = {"entries": {}, "version": None, "scanned_at": 0.0}
+_assets_lock = asyncio.Lock()
+
+
+def _hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(ASSETS_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _build_gzip_variant(path: Path, digest: str) -> Optional[Path]:
+    """Genera <cache>/<hash>.gz una sola vez; None si no reduce el tamaño."""
+    gz_path = ASSETS_CACHE_DIR / f"{digest}.gz"
+    if gz_path.exists():
+        return gz_path
+    data = path.read_bytes()
+    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(compressed) >= len(data) * 0.9:
+        return None
+    ASSETS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = ASSETS_CACHE_DIR / f".{digest}.{os.getpid()}.tmp"
+    tmp.write_bytes(compressed)
+    os.replace(tmp, gz_path)
+    return gz_path
+
+
+def scan_assets(previous: Dict[str, Dict]) -> Dict[str, Dict]:
+    """Recorre STATIC_ASSETS_DIR; solo re-hashea archivos con mtime/tamaño distinto."""
+    entries: Dict[str, Dict] = {}
+    for path in sorted(STATIC_ASSETS_DIR.rglob("*")):
+        if not path.is_file() or path.name.startswith("."):
+            continue
+        rel = path.relative_to(STATIC_ASSETS_DIR).as_posix()
+        stat = path.stat()
+        old = previous.get(rel)
+        if old and old["mtime"] == stat.st_mtime and old["size"] == stat.st_size:
+            entries[rel] = old
+            continue
+
+        digest = _hash_file(path)
+        gz_path = None
+        if path.suffix.lower() in ASSETS_COMPRESSIBLE and stat.st_size >= ASSETS_MIN_GZIP_SIZE:
+            try:
+                gz_path = _build_gzip_variant(path, digest)
+            except OSError as e:
+                logger.warning("No se pudo precomprimir %s: %s", rel, e)
+        entries[rel] = {
+            "path": path,
+            "hash": digest,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "content_type": mimetypes.guess_type(path.name)[0] or "application/octet-stream",
+            "gzip_path": gz_path,
+            "gzip_size": gz_path.stat().st_size if gz_path else None,
+        }
+    return entries
+
+
+async def get_assets_entries() -> Dict[str, Dict]:
+    if _assets_state["version"] and time.monotonic() - _assets_state["scanned_at"] < ASSETS_RESCAN_SECONDS:
+        return _assets_state["entries"]
+    async with _assets_lock:
+        if not _assets_state["version"] or time.monotonic() - _assets_state["scanned_at"] >= ASSETS_RESCAN_SECONDS:
+            try:
+                entries = await run_in_threadpool(scan_assets, _assets_state["entries"])
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                http_500("Error al indexar los assets", e)
+            version = hashlib.sha256(
+                "".join(f"{rel}:{e['hash']}" for rel, e in entries.items()).encode("utf-8")
+            ).hexdigest()[:16]
+            _assets_state.update(entries=entries, version=version, scanned_at=time.monotonic())
+    return _assets_state["entries"]
+
+
+def parse_range_header(range_header: str, size: int) -> Optional[tuple]:
+    """'bytes=a-b' -> (inicio, fin) inclusivo. None = ignorar (servir completo).
+    Lanza 416 si el rango no es satisfacible. Rangos múltiples se ignoran."""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_s, sep, end_s = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not start_s:
+            suffix = int(end_s)
+            if suffix <= 0:
+                raise ValueError
+            start, end = max(0, size - suffix), size - 1
+        else:
+            start = int(start_s)
+            end = int(end_s) if end_s else size - 1
+            if end_s and end < start:
+                # last-byte-pos < first-byte-pos: rango inválido, se ignora (RFC 9110 §14.1.1)
+                return None
+            end = min(end, size - 1)
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(
+            status_code=416, detail="Rango no satisfacible", headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+
+class FileRangeResponse(Response):
+    """Envía [offset, offset+count) de un archivo en bloques, sin cargarlo en memoria."""
+
+    def __init__(self, path: Path, offset: int, count: int, status_code: int, headers: Dict, media_type: str):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.path = path
+        self.offset = offset
+        self.count = count
+        self.headers["content-length"] = str(count)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope.get("method") == "HEAD" or self.count == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        remaining = self.count
+        async with await anyio.open_file(self.path, "rb") as f:
+            await f.seek(self.offset)
+            while remaining > 0:
+                chunk = await f.read(min(ASSETS_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        if remaining > 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+@api_router.get("/assets/manifest")
+async def get_assets_manifest(request: Request):
+    entries = await get_assets_entries()
+    version = _assets_state["version"]
+    etag = f'"{version}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    manifest = {
+        "version": version,
+        "assets": {
+            rel: {
+                "hash": e["hash"],
+                "size": e["size"],
+                "content_type": e["content_type"],
+                "url": f"/api/assets/{e['hash'][:16]}/{rel}",
+            }
+            for rel, e in entries.items()
+        },
+    }
+    return Response(content=json.dumps(manifest, ensure_ascii=False), media_type="application/json", headers=headers)
+
+
+@api_router.api_route("/assets/{asset_hash}/{asset_path:path}", methods=["GET", "HEAD"])
+async def get_asset(asset_hash: str, asset_path: str, request: Request):
+    entries = await get_assets_entries()
+    entry = entries.get(asset_path)
+    if not entry or not entry["hash"].startswith(asset_hash) or len(asset_hash) < 8:
+        raise HTTPException(status_code=404, detail="Asset no encontrado")
+
+    range_header = request.headers.get("range")
+    # Los rangos se sirven siempre sobre la representación sin comprimir
+    use_gzip = bool(
+        entry["gzip_path"] and not range_header and "gzip" in request.headers.get("accept-encoding", "").lower()
+    )
+    # Cada representación lleva su propio ETag fuerte (RFC 9110 §8.8.3)
+    etag = f'"{entry["hash"][:16]}-gz"' if use_gzip else f'"{entry["hash"][:16]}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+        "Vary": "Accept-Encoding",
     }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return FileRangeResponse(entry["gzip_path"], 0, entry["gzip_size"], 200, headers, entry["content_type"])
+
+    size = entry["size"]
+    byte_range = parse_range_header(range_header, size) if range_header else None
+    if byte_range:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        return FileRangeResponse(entry["path"], start, end - start + 1, 206, headers, entry["content_type"])
+
+    return FileRangeResponse(entry["path"], 0, size, 200, headers, entry["content_type"])
+
+
+# ------------------------ DEBUG (perfilado y requests lentos) --------
+# Solo para administradores (require_admin, ver TOKENS DE SESIÓN).
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "500"))
+SLOW_REQUEST_BUFFER = int(os.environ.get("SLOW_REQUEST_BUFFER", "100"))
+PROFILE_MAX_SECONDS = 60
+TASK_SNAPSHOT_LIMIT = 50
+
+slow_requests: deque = deque(maxlen=SLOW_REQUEST_BUFFER)
+_profile_lock = asyncio.Lock()
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})".replace(";", ":")
+
+
+def sample_stacks(seconds: float, interval: float) -> Counter:
+    """Muestrea las pilas de todos los hilos (menos este) cada `interval` s.
+    Devuelve {pila colapsada: muestras}, formato de flamegraph.pl / speedscope."""
+    counts: Counter = Counter()
+    me = threading.get_ident()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for tid, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if tid == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(tid, str(tid)))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+
+def snapshot_tasks() -> List[Dict]:
+    tasks = []
+    for task in list(asyncio.all_tasks())[:TASK_SNAPSHOT_LIMIT]:
+        coro = task.get_coro()
+        tasks.append(
+            {
+                "name": task.get_name(),
+                "coro": getattr(coro, "__qualname__", repr(coro)),
+                "stack": [_frame_label(f) for f in task.get_stack(limit=10)],
+            }
+        )
+    return tasks
+
+
+class SlowRequestMiddleware:
+    """Middleware ASGI puro: mide cada request hasta el último mensaje del
+    cuerpo y guarda los lentos en slow_requests. No toca los mensajes, así
+    que las respuestas en streaming no se acumulan en memoria."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = {"mongo": [], "pending": {}}
+        started_at = datetime.now(timezone.utc)
+        start = time.perf_counter()
+        status_code = None
+        recorded = False
+
+        def record():
+            nonlocal recorded
+            recorded = True
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if elapsed_ms < SLOW_REQUEST_MS:
+                return
+            route = scope.get("route")
+            slow_requests.append(
+                {
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "route": getattr(route, "path", None),
+                    "status": status_code or 500,
+                    "started_at": started_at.isoformat(),
+                    "duration_ms": round(elapsed_ms, 3),
+                    "mongo_ms": round(sum(c["duration_ms"] or 0 for c in trace["mongo"]), 3),
+                    "mongo": trace["mongo"],
+                    "tasks": snapshot_tasks(),
+                }
+            )
+            logger.warning("Request lento %s %s: %.1f ms", scope["method"], scope["path"], elapsed_ms)
+
+        async def timed_send(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False) and not recorded:
+                record()
+
+        ctx_token = _request_trace.set(trace)
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            _request_trace.reset(ctx_token)
+            # Sin cuerpo final (error o cliente desconectado): se mide igual
+            if not recorded:
+                record()
+
+
+app.add_middleware(SlowRequestMiddleware)
+
+
+@api_router.post("/debug/profile", dependencies=[Depends(require_admin)])
+async def profile_live_traffic(seconds: float = 10, interval_ms: float = 5):
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds debe estar entre 0 y {PROFILE_MAX_SECONDS}")
+    if not 1 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms debe estar entre 1 y 1000")
+    if _profile_lock.locked():
+        raise HTTPException(status_code=409, detail="Ya hay un perfilado en curso")
+
+    async with _profile_lock:
+        # El muestreo corre en un hilo: el event loop sigue atendiendo tráfico
+        counts = await run_in_threadpool(sample_stacks, seconds, interval_ms / 1000)
+    body = "\n".join(f"{stack} {n}" for stack, n in counts.most_common())
+    return PlainTextResponse(
+        body + "\n",
+        headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'},
+    )
+
+
+@api_router.get("/debug/slow", dependencies=[Depends(require_admin)])
+async def get_slow_requests(limit: int = SLOW_REQUEST_BUFFER):
+    return {"threshold_ms": SLOW_REQUEST_MS, "requests": list(slow_requests)[-limit:][::-1]}
+
+
+@api_router.get("/debug/singleflight", dependencies=[Depends(require_admin)])
+async def single_flight_stats():
+    """Llamadas vs consultas reales por ruta (calls - executions = lecturas ahorradas)."""
+    return single_flight.stats
+
+
+@api_router.get("/debug/mongo-commands", dependencies=[Depends(require_admin)])
+async def mongo_command_stats():
+    """Comandos reales enviados a Mongo desde el arranque, por "comando:colección"."""
+    with _mongo_counts_lock:
+        return dict(mongo_command_counts)
 
 
 # ------------------------ ROOT & CORS --------------------------------
@@ -763,6 +2456,41 @@ app.add_middleware(
 )
 
 
+# ------------------------ STARTUP ------------------------------------
+@app.on_event("startup")
+async def init_db_indexes():
+    try:
+        await db.users.create_index("username", unique=True)
+        _username_index_ready.set()
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logger.error("No se pudo crear el índice único de username (register usará lectura previa): %s", e)
+    # get_progress depende de este índice para no duplicar progresos. Con
+    # duplicados previos no se borra nada aquí: el arranque falla y la limpieza
+    # se hace a mano con dedupe_progress.py
+    try:
+        await db.progress.create_index("user_id", unique=True)
+    except OperationFailure as e:
+        if e.code == 11000:
+            logger.critical(
+                "Hay progresos duplicados por user_id: revisa y ejecuta `python dedupe_progress.py --apply` antes de arrancar"
+            )
+        raise
+    try:
+        await db.game_history.create_index([("user_id", 1), ("month", -1), ("count", 1)])
+        await db.game_history.create_index([("user_id", 1), ("last_at", -1)])
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logger.error("No se pudieron crear los índices de game_history: %s", e)
+    try:
+        await db.market_sessions.create_index([("classroom_id", 1), ("day", 1)], unique=True)
+        await db.market_portfolios.create_index([("classroom_id", 1), ("day", 1), ("user_id", 1)], unique=True)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logger.error("No se pudieron crear los índices del mercado: %s", e)
+    try:
+        await load_username_bloom()
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logger.error("No se pudo cargar el filtro de usernames: %s", e)
+
+
 # ------------------------ SHUTDOWN -----------------------------------
 @app.on_event("shutdown")
 async def shutdown_db_client():
@@ -8,14 +8,26 @@ Realiza pruebas automáticas básicas sobre los endpoints principales
 para comprobar la correcta comunicación entre servidor y base de datos.
 """
 
+import os
 import requests
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import jwt
 
 # ==============================================
 # CONFIGURACIÓN
 # ==============================================
 # Cambia esta URL si tu API está desplegada en otro servidor o puerto
 BASE_URL = "http://localhost:8000/api"
+# Necesario para los endpoints /api/debug/* (mismo valor que ADMIN_TOKEN del backend)
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+# Mismo JWT_SECRET del backend: permite fabricar un token expirado
+JWT_SECRET = os.environ.get("JWT_SECRET", "")
+# Mismo HISTORY_BUCKET_SIZE del backend: la prueba de historial llena un bucket y sigue en otro
+HISTORY_BUCKET_SIZE = int(os.environ.get("HISTORY_BUCKET_SIZE", "200"))
 
 
 class FinaKiHubAPITester:
@@ -23,6 +35,9 @@ class FinaKiHubAPITester:
         self.base_url = BASE_URL
         self.session = requests.Session()
         self.test_user_id = None
+        self.token = None
+        self.reward_user_id = None
+        self.reward_token = None
         self.results = []
 
     # ----------------------------------------------
@@ -47,6 +62,7 @@ class FinaKiHubAPITester:
                 data = response.json()
                 if "id" in data:
                     self.test_user_id = data["id"]
+                    self.token = data.get("access_token")
                     self.log_result("Register User", True, f"Usuario creado ID={self.test_user_id}")
                     return True
             self.log_result("Register User", False, f"Código {response.status_code}")
@@ -60,6 +76,12 @@ class FinaKiHubAPITester:
         try:
             response = self.session.post(f"{self.base_url}/auth/login", json=payload)
             if response.status_code == 200:
+                data = response.json()
+                self.test_user_id = data.get("id", self.test_user_id)
+                self.token = data.get("access_token")
+                if not self.token:
+                    self.log_result("Login User", False, "La respuesta no trae access_token")
+                    return False
                 self.log_result("Login User", True)
                 return True
             self.log_result("Login User", False, f"Código {response.status_code}")
@@ -67,6 +89,79 @@ class FinaKiHubAPITester:
             self.log_result("Login User", False, f"Error: {e}")
         return False
 
+    def test_username_available(self):
+        """GET /api/auth/username-available: ocupado tras registrar, libre si nadie lo usa"""
+        url = f"{self.base_url}/auth/username-available"
+        unused = f"libre_{int(time.time() * 1000)}"
+        try:
+            taken = self.session.get(url, params={"username": "testuser1"})
+            free = self.session.get(url, params={"username": unused})
+            if taken.status_code != 200 or free.status_code != 200:
+                self.log_result("Username Available", False, f"Códigos {taken.status_code}/{free.status_code}")
+                return False
+            ok = taken.json()["available"] is False and free.json()["available"] is True
+            self.log_result("Username Available", ok, f"testuser1={taken.json()['available']}, {unused}={free.json()['available']}")
+            return ok
+        except Exception as e:
+            self.log_result("Username Available", False, f"Error: {e}")
+        return False
+
+    def auth(self, token=None):
+        return {"Authorization": f"Bearer {token or self.token}"}
+
+    # ----------------------------------------------
+    # PRUEBAS DE TOKEN DE SESIÓN
+    # ----------------------------------------------
+    def test_token_required(self):
+        """POST /api/xp/add sin token -> 401"""
+        try:
+            response = self.session.post(f"{self.base_url}/xp/add", json={"user_id": self.test_user_id, "xp": 1})
+            ok = response.status_code == 401
+            self.log_result("Token Required", ok, f"Código {response.status_code}")
+            return ok
+        except Exception as e:
+            self.log_result("Token Required", False, f"Error: {e}")
+        return False
+
+    def test_token_wrong_user(self):
+        """POST /api/xp/add con token de otro usuario -> 403"""
+        if not self.token:
+            self.log_result("Token Wrong User", False, "No hay token disponible")
+            return False
+        try:
+            other_id = "0" * 24 if self.test_user_id != "0" * 24 else "1" * 24
+            response = self.session.post(
+                f"{self.base_url}/xp/add", json={"user_id": other_id, "xp": 1}, headers=self.auth()
+            )
+            ok = response.status_code == 403
+            self.log_result("Token Wrong User", ok, f"Código {response.status_code}")
+            return ok
+        except Exception as e:
+            self.log_result("Token Wrong User", False, f"Error: {e}")
+        return False
+
+    def test_token_expired(self):
+        """POST /api/xp/add con token expirado -> 401"""
+        if not JWT_SECRET or not self.test_user_id:
+            self.log_result("Token Expired", False, "Define JWT_SECRET (el mismo del backend)")
+            return False
+        try:
+            now = int(time.time())
+            expired = jwt.encode(
+                {"sub": self.test_user_id, "lvl": "primaria", "iat": now - 7200, "exp": now - 3600},
+                JWT_SECRET,
+                algorithm="HS256",
+            )
+            response = self.session.post(
+                f"{self.base_url}/xp/add", json={"user_id": self.test_user_id, "xp": 1}, headers=self.auth(expired)
+            )
+            ok = response.status_code == 401
+            self.log_result("Token Expired", ok, f"Código {response.status_code}")
+            return ok
+        except Exception as e:
+            self.log_result("Token Expired", False, f"Error: {e}")
+        return False
+
     # ----------------------------------------------
     # PRUEBA DE PERFIL DE USUARIO
     # ----------------------------------------------
@@ -87,6 +182,347 @@ class FinaKiHubAPITester:
             self.log_result("Get Profile", False, f"Error: {e}")
         return False
 
+    # ----------------------------------------------
+    # PRUEBAS DE RECOMPENSAS E INSIGNIAS
+    # ----------------------------------------------
+    # Usuario nuevo en cada ejecución: las insignias solo se ganan una vez
+    def _register_fresh_user(self):
+        payload = {"username": f"premios_{int(time.time() * 1000)}", "age": 10}
+        response = self.session.post(f"{self.base_url}/auth/register", json=payload)
+        response.raise_for_status()
+        data = response.json()
+        self.reward_user_id, self.reward_token = data["id"], data["access_token"]
+
+    def _reward_post(self, path, payload):
+        response = self.session.post(
+            f"{self.base_url}/{path}",
+            json={"user_id": self.reward_user_id, **payload},
+            headers=self.auth(self.reward_token),
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def test_coins_badge(self):
+        """POST /api/coins/add hasta 200 monedas → coin_collector"""
+        try:
+            self._register_fresh_user()
+            below = self._reward_post("coins/add", {"coins": 150})
+            reached = self._reward_post("coins/add", {"coins": 50})
+            ok = (
+                "coin_collector" not in below["new_badges"]
+                and reached["new_total"] == 200
+                and "coin_collector" in reached["new_badges"]
+            )
+            self.log_result("Coins Badge", ok, f"150 → {below['new_badges']}, 200 → {reached['new_badges']}")
+            return ok
+        except Exception as e:
+            self.log_result("Coins Badge", False, f"Error: {e}")
+        return False
+
+    def test_purchase_badge(self):
+        """POST /api/shop/purchase: primera compra → first_purchase e id guardado tal cual"""
+        if not self.reward_user_id:
+            self.log_result("Purchase Badge", False, "No hay usuario de recompensas")
+            return False
+        try:
+            data = self._reward_post("shop/purchase", {"item_id": "hat_cap", "price": 10})
+            user = self.session.get(f"{self.base_url}/user/{self.reward_user_id}").json()
+            ok = (
+                data["new_coins"] == 190
+                and data["new_badges"] == ["first_purchase"]
+                and user["purchased_items"] == ["hat_cap"]
+            )
+            self.log_result("Purchase Badge", ok, f"new_badges={data['new_badges']} purchased_items={user['purchased_items']}")
+            return ok
+        except Exception as e:
+            self.log_result("Purchase Badge", False, f"Error: {e}")
+        return False
+
+    def test_progress_badges(self):
+        """POST /api/progress/update con lemonade_stand → first_module y lemonade_master"""
+        if not self.reward_user_id:
+            self.log_result("Progress Badges", False, "No hay usuario de recompensas")
+            return False
+        try:
+            data = self._reward_post(
+                "progress/update",
+                {"completed_modules": ["lemonade_stand"], "module_scores": {"lemonade_stand": 80}, "total_score": 80},
+            )
+            ok = sorted(data["new_badges"]) == ["first_module", "lemonade_master"]
+            self.log_result("Progress Badges", ok, f"new_badges={data['new_badges']}")
+            return ok
+        except Exception as e:
+            self.log_result("Progress Badges", False, f"Error: {e}")
+        return False
+
+    def test_xp_badge(self):
+        """POST /api/xp/add cruzando 1000 XP → xp_master una sola vez"""
+        if not self.reward_user_id:
+            self.log_result("XP Badge", False, "No hay usuario de recompensas")
+            return False
+        try:
+            first = self._reward_post("xp/add", {"xp": 1000})
+            repeat = self._reward_post("xp/add", {"xp": 10})
+            ok = (
+                first["new_xp"] == 1000
+                and "xp_master" in first["new_badges"]
+                and "xp_master" not in repeat["new_badges"]
+            )
+            self.log_result("XP Badge", ok, f"1000 XP → {first['new_badges']}, repetición → {repeat['new_badges']}")
+            return ok
+        except Exception as e:
+            self.log_result("XP Badge", False, f"Error: {e}")
+        return False
+
+    # ----------------------------------------------
+    # PRUEBA DE AVATAR
+    # ----------------------------------------------
+    def test_avatar_render(self):
+        """GET /api/avatar/render.png: 200, 304 con If-None-Match y 400 con tamaño inválido"""
+        url = f"{self.base_url}/avatar/render.png"
+        params = {"size": 160, "gender": "girl", "background": "bosque"}
+        try:
+            first = self.session.get(url, params=params)
+            etag = first.headers.get("ETag")
+            if first.status_code != 200 or first.headers.get("Content-Type") != "image/png" or not etag:
+                self.log_result("Avatar Render", False, f"Código {first.status_code}, ETag={etag}")
+                return False
+            again = self.session.get(url, params=params, headers={"If-None-Match": etag})
+            bad_size = self.session.get(url, params={**params, "size": 123})
+            ok = again.status_code == 304 and not again.content and bad_size.status_code == 400
+            self.log_result(
+                "Avatar Render", ok, f"200 → {again.status_code} con If-None-Match, tamaño inválido → {bad_size.status_code}"
+            )
+            return ok
+        except Exception as e:
+            self.log_result("Avatar Render", False, f"Error: {e}")
+        return False
+
+    # ----------------------------------------------
+    # PRUEBAS DE ASSETS ESTÁTICOS
+    # ----------------------------------------------
+    def _asset_url(self, suffixes):
+        """URL y tamaño del primer asset del manifiesto con alguna de esas extensiones."""
+        assets = self.session.get(f"{self.base_url}/assets/manifest").json()["assets"]
+        for rel, asset in sorted(assets.items()):
+            if rel.lower().endswith(suffixes):
+                return self.base_url.rsplit("/api", 1)[0] + asset["url"], asset["size"]
+        return None, None
+
+    def test_assets_manifest(self):
+        """GET /api/assets/manifest: 200 con ETag y 304 con If-None-Match"""
+        try:
+            response = self.session.get(f"{self.base_url}/assets/manifest")
+            etag = response.headers.get("ETag")
+            if response.status_code != 200 or not etag or not response.json().get("assets"):
+                self.log_result("Assets Manifest", False, f"Código {response.status_code}, ETag={etag}")
+                return False
+            again = self.session.get(f"{self.base_url}/assets/manifest", headers={"If-None-Match": etag})
+            ok = again.status_code == 304
+            self.log_result("Assets Manifest", ok, f"{len(response.json()['assets'])} assets, revalidación → {again.status_code}")
+            return ok
+        except Exception as e:
+            self.log_result("Assets Manifest", False, f"Error: {e}")
+        return False
+
+    def test_assets_range(self):
+        """GET/HEAD /api/assets/{hash}/{path}: 206, 416, rango inválido ignorado y HEAD sin cuerpo"""
+        try:
+            url, size = self._asset_url((".png", ".mp3", ".mp4", ".wav", ".ttf"))
+            if not url:
+                self.log_result("Assets Range", False, "El manifiesto no tiene assets")
+                return False
+            plain = {"Accept-Encoding": "identity"}
+            partial = self.session.get(url, headers={**plain, "Range": "bytes=0-9"})
+            unsatisfiable = self.session.get(url, headers={**plain, "Range": f"bytes={size}-"})
+            reversed_range = self.session.get(url, headers={**plain, "Range": "bytes=5-3"})
+            head = self.session.head(url, headers=plain)
+            checks = {
+                "206": partial.status_code == 206
+                and partial.headers.get("Content-Range") == f"bytes 0-9/{size}"
+                and len(partial.content) == 10,
+                "416": unsatisfiable.status_code == 416
+                and unsatisfiable.headers.get("Content-Range") == f"bytes */{size}",
+                "5-3 → 200": reversed_range.status_code == 200 and len(reversed_range.content) == size,
+                "HEAD": head.status_code == 200
+                and not head.content
+                and head.headers.get("Content-Length") == str(size),
+            }
+            ok = all(checks.values())
+            self.log_result("Assets Range", ok, ", ".join(f"{k}={'ok' if v else 'falla'}" for k, v in checks.items()))
+            return ok
+        except Exception as e:
+            self.log_result("Assets Range", False, f"Error: {e}")
+        return False
+
+    def test_assets_gzip(self):
+        """La variante gzip lleva su propio ETag y Vary: Accept-Encoding"""
+        try:
+            url, _ = self._asset_url((".wav", ".ttf"))
+            if not url:
+                self.log_result("Assets Gzip", False, "No hay assets comprimibles en el manifiesto")
+                return False
+            gz = self.session.get(url, headers={"Accept-Encoding": "gzip"})
+            plain = self.session.get(url, headers={"Accept-Encoding": "identity"})
+            gz_etag, plain_etag = gz.headers.get("ETag"), plain.headers.get("ETag")
+            vary_ok = all("Accept-Encoding" in r.headers.get("Vary", "") for r in (gz, plain))
+            if gz.headers.get("Content-Encoding") == "gzip":
+                ok = vary_ok and gz_etag != plain_etag and gz_etag.endswith('-gz"')
+            else:
+                # El asset no se comprimió (no reducía el tamaño): misma representación
+                ok = vary_ok and gz_etag == plain_etag
+            self.log_result("Assets Gzip", ok, f"ETag gzip={gz_etag} identity={plain_etag}")
+            return ok
+        except Exception as e:
+            self.log_result("Assets Gzip", False, f"Error: {e}")
+        return False
+
+    # ----------------------------------------------
+    # PRUEBA DE ALTA MASIVA (CLASSROOM)
+    # ----------------------------------------------
+    def test_bulk_students(self):
+        """POST /api/classroom/{classroom_id}/students/bulk con conflictos por fila"""
+        if not ADMIN_TOKEN:
+            self.log_result("Bulk Students", False, "Define ADMIN_TOKEN: el alta masiva es solo para docentes")
+            return False
+        fresh = f"alumno_{int(time.time() * 1000)}"
+        payload = {
+            "students": [
+                {"username": "testuser1", "age": 10},  # ya existe
+                {"username": fresh, "age": 9},
+                {"username": fresh, "age": 9},  # repetido en la lista
+            ],
+        }
+        try:
+            response = self.session.post(
+                f"{self.base_url}/classroom/aula-test/students/bulk", json=payload, headers=self.auth()
+            )
+            if response.status_code != 403:
+                self.log_result("Bulk Students", False, f"Un token de alumno obtuvo {response.status_code} (esperado 403)")
+                return False
+            response = self.session.post(
+                f"{self.base_url}/classroom/aula-test/students/bulk",
+                json=payload,
+                headers={"X-Admin-Token": ADMIN_TOKEN},
+            )
+            if response.status_code != 200:
+                self.log_result("Bulk Students", False, f"Código {response.status_code}")
+                return False
+            data = response.json()
+            created = [(c["row"], c["username"]) for c in data["created"]]
+            conflicts = [(c["row"], c["username"], c["reason"]) for c in data["conflicts"]]
+            ok = (
+                created == [(1, fresh)]
+                and conflicts == [(0, "testuser1", "Usuario ya existe"), (2, fresh, "Repetido en la lista")]
+            )
+            self.log_result("Bulk Students", ok, f"created={created} conflicts={conflicts}")
+            return ok
+        except Exception as e:
+            self.log_result("Bulk Students", False, f"Error: {e}")
+        return False
+
+    # ----------------------------------------------
+    # PRUEBA DE HISTORIAL DE PARTIDAS
+    # ----------------------------------------------
+    def test_history_pagination(self):
+        """POST /api/history + GET /api/history/{user_id} paginando entre buckets"""
+        if not self.test_user_id or not self.token:
+            self.log_result("History Pagination", False, "No hay user_id/token disponible")
+            return False
+        # Todas en el mismo mes para que el primer bucket se llene y se abra otro
+        total = HISTORY_BUCKET_SIZE + 5
+        expected = []
+        try:
+            for i in range(total):
+                payload = {
+                    "user_id": self.test_user_id,
+                    "module": "lemonade_stand",
+                    "score": i,
+                    "finished_at": f"2020-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}",
+                }
+                response = self.session.post(f"{self.base_url}/history", json=payload, headers=self.auth())
+                if response.status_code != 200:
+                    self.log_result("History Pagination", False, f"POST código {response.status_code}")
+                    return False
+                expected.append(response.json()["id"])
+            expected.reverse()
+
+            seen, cursor = [], None
+            while True:
+                params = {"limit": 30}
+                if cursor:
+                    params["cursor"] = cursor
+                response = self.session.get(f"{self.base_url}/history/{self.test_user_id}", params=params)
+                if response.status_code != 200:
+                    self.log_result("History Pagination", False, f"GET código {response.status_code}")
+                    return False
+                data = response.json()
+                seen.extend(entry["id"] for entry in data["sessions"])
+                cursor = data["next_cursor"]
+                if not cursor:
+                    break
+
+            # Sin huecos ni repetidos y en orden, también al cruzar de bucket
+            # (se ignoran sesiones de ejecuciones anteriores con el mismo usuario)
+            posted = set(expected)
+            seen = [entry for entry in seen if entry in posted]
+            ok = seen == expected
+            self.log_result("History Pagination", ok, f"{len(seen)}/{total} sesiones en orden")
+            return ok
+        except Exception as e:
+            self.log_result("History Pagination", False, f"Error: {e}")
+        return False
+
+    # ----------------------------------------------
+    # PRUEBA DE ESTRÉS: SINGLE-FLIGHT
+    # ----------------------------------------------
+    def _burst(self, url, concurrency):
+        """Lanza `concurrency` GET idénticos liberados a la vez."""
+        barrier = threading.Barrier(concurrency)
+
+        def hit(_):
+            barrier.wait()
+            return requests.get(url).status_code
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(hit, range(concurrency)))
+
+    # Comando de Mongo que emite cada ruta (contado por el CommandListener del backend)
+    STRESS_ROUTES = (
+        ("get_progress", "progress", "findAndModify:progress"),
+        ("get_user", "user", "find:users"),
+    )
+    # Consultas permitidas por ráfaga, sin importar cuántos duplicados haya
+    STRESS_MAX_DB_OPS = 2
+
+    def test_single_flight_stress(self):
+        """GET /api/progress/{user_id} y /api/user/{user_id} con duplicados concurrentes"""
+        if not self.test_user_id:
+            self.log_result("Single-flight Stress", False, "No hay user_id disponible")
+            return False
+        if not ADMIN_TOKEN:
+            self.log_result("Single-flight Stress", False, "Define ADMIN_TOKEN para leer /debug/mongo-commands")
+            return False
+        admin = {"X-Admin-Token": ADMIN_TOKEN}
+        try:
+            details = []
+            ok = True
+            for route, path, command in self.STRESS_ROUTES:
+                for concurrency in (1, 10, 50):
+                    before = self.session.get(f"{self.base_url}/debug/mongo-commands", headers=admin).json()
+                    codes = self._burst(f"{self.base_url}/{path}/{self.test_user_id}", concurrency)
+                    after = self.session.get(f"{self.base_url}/debug/mongo-commands", headers=admin).json()
+                    db_ops = after.get(command, 0) - before.get(command, 0)
+                    details.append(f"{route} x{concurrency}: {db_ops} comandos Mongo")
+                    # Cota constante: los comandos reales no crecen con los duplicados
+                    if any(code != 200 for code in codes) or db_ops > self.STRESS_MAX_DB_OPS:
+                        ok = False
+            self.log_result("Single-flight Stress", ok, "; ".join(details))
+            return ok
+        except Exception as e:
+            self.log_result("Single-flight Stress", False, f"Error: {e}")
+        return False
+
     # ----------------------------------------------
     # EJECUCIÓN GENERAL
     # ----------------------------------------------
@@ -99,11 +535,44 @@ class FinaKiHubAPITester:
         print("\n🔐 AUTENTICACIÓN")
         self.test_register_user()
         self.test_login_user()
+        self.test_username_available()
+        self.test_token_required()
+        self.test_token_wrong_user()
+        self.test_token_expired()
 
         # Perfil de usuario
         print("\n👤 PERFIL DE USUARIO")
         self.test_get_profile()
 
+        # Recompensas
+        print("\n🏅 RECOMPENSAS E INSIGNIAS")
+        self.test_coins_badge()
+        self.test_purchase_badge()
+        self.test_progress_badges()
+        self.test_xp_badge()
+
+        # Avatar
+        print("\n🧑‍🎨 AVATAR")
+        self.test_avatar_render()
+
+        # Assets estáticos
+        print("\n📦 ASSETS")
+        self.test_assets_manifest()
+        self.test_assets_range()
+        self.test_assets_gzip()
+
+        # Alta masiva
+        print("\n🏫 ALTA MASIVA")
+        self.test_bulk_students()
+
+        # Historial
+        print("\n🕹️ HISTORIAL DE PARTIDAS")
+        self.test_history_pagination()
+
+        # Concurrencia
+        print("\n⚡ CONCURRENCIA")
+        self.test_single_flight_stress()
+
         # Resumen
         print("\n📋 RESUMEN DE PRUEBAS")
         print("=" * 60)
@@ -16,8 +16,12 @@ import {
 import { useRouter } from 'expo-router';
 
 import { Colors } from '../../constants/Colors';
-import { registerUser, saveUserToStorage } from '../../utils/api';
+import { checkUsernameAvailable, registerUser, saveUserToStorage } from '../../utils/api';
 import { useUserStore } from '../../store/userStore';
+import { useTimeout } from '../../src/hooks/useTimeout';
+
+type NameStatus = 'idle' | 'checking' | 'available' | 'taken';
+const NAME_CHECK_DEBOUNCE_MS = 400;
 
 export default function Register() {
   const router = useRouter();
@@ -27,6 +31,7 @@ export default function Register() {
   const [email, setEmail] = useState('');
   const [password, setPassword] = useState('');
   const [loading, setLoading] = useState(false);
+  const [nameStatus, setNameStatus] = useState<NameStatus>('idle');
 
   // evita setState tras desmontar
   const mountedRef = useRef(true);
@@ -35,6 +40,28 @@ export default function Register() {
     return () => { mountedRef.current = false; };
   }, []);
 
+  // Disponibilidad del nombre mientras se escribe (con debounce; ignora respuestas viejas)
+  const { schedule, clear } = useTimeout();
+  const checkSeq = useRef(0);
+  useEffect(() => {
+    const candidate = name.trim();
+    const seq = ++checkSeq.current;
+    if (!candidate) {
+      clear();
+      setNameStatus('idle');
+      return;
+    }
+    setNameStatus('checking');
+    schedule(async () => {
+      try {
+        const available = await checkUsernameAvailable(candidate);
+        if (mountedRef.current && seq === checkSeq.current) setNameStatus(available ? 'available' : 'taken');
+      } catch {
+        if (mountedRef.current && seq === checkSeq.current) setNameStatus('idle');
+      }
+    }, NAME_CHECK_DEBOUNCE_MS);
+  }, [name, schedule, clear]);
+
   const goLogin = useCallback(() => router.replace('/(auth)/login'), [router]);
 const goTabs = useCallback(() => router.replace('/(tabs)' as any), [router]);
 
@@ -43,6 +70,10 @@ const goTabs = useCallback(() => router.replace('/(tabs)' as any), [router]);
       Alert.alert('Campos incompletos', 'Completa nombre, correo y contraseña.');
       return;
     }
+    if (nameStatus === 'taken') {
+      Alert.alert('Nombre en uso', 'Ese nombre ya existe. Prueba con otro.');
+      return;
+    }
     try {
       setLoading(true);
 
@@ -70,7 +101,7 @@ const goTabs = useCallback(() => router.replace('/(tabs)' as any), [router]);
     } finally {
       if (mountedRef.current) setLoading(false);
     }
-  }, [name, email, password, setUser, goTabs]);
+  }, [name, email, password, nameStatus, setUser, goTabs]);
 
   return (
     <KeyboardAvoidingView style={styles.flex} behavior={Platform.OS === 'ios' ? 'padding' : undefined}>
@@ -87,6 +118,21 @@ const goTabs = useCallback(() => router.replace('/(tabs)' as any), [router]);
             style={styles.input}
             accessible accessibilityLabel="Campo de nombre"
           />
+          {nameStatus !== 'idle' && (
+            <Text
+              style={[
+                styles.nameStatus,
+                nameStatus === 'available' && { color: Colors?.success ?? '#16A34A' },
+                nameStatus === 'taken' && { color: Colors?.error ?? '#DC2626' },
+              ]}
+            >
+              {nameStatus === 'checking'
+                ? 'Comprobando nombre…'
+                : nameStatus === 'available'
+                ? '✓ Nombre disponible'
+                : '✗ Ese nombre ya está en uso'}
+            </Text>
+          )}
 
           <Text style={[styles.label, { marginTop: 12 }]}>Correo</Text>
           <TextInput
@@ -115,9 +161,9 @@ const goTabs = useCallback(() => router.replace('/(tabs)' as any), [router]);
 
           <TouchableOpacity
             onPress={onRegister}
-            disabled={loading}
+            disabled={loading || nameStatus === 'taken'}
             accessibilityRole="button"
-            style={[styles.primaryBtn, loading && { opacity: 0.7 }]}
+            style={[styles.primaryBtn, (loading || nameStatus === 'taken') && { opacity: 0.7 }]}
           >
             {loading ? <ActivityIndicator color="#fff" /> : <Text style={styles.primaryBtnText}>Crear cuenta</Text>}
           </TouchableOpacity>
@@ -155,6 +201,7 @@ const styles = StyleSheet.create({
     fontSize: 16,
     backgroundColor: '#fff',
   },
+  nameStatus: { marginTop: 6, fontSize: 13, color: Colors?.textLight ?? '#6B7280' },
   link: { textAlign: 'center', color: Colors?.primary ?? '#18A7A7', fontWeight: '600' },
 
   primaryBtn: {
@@ -8,7 +8,15 @@ import { Image } from 'expo-image';
 
 const BANNER = require('../../assets/images/banner_antar.png');
 
-const ALL_BADGES = ['first_module', 'lemonade_master', 'saver', 'financial_wizard'];
+const ALL_BADGES = [
+  'first_module',
+  'lemonade_master',
+  'saver',
+  'financial_wizard',
+  'xp_master',
+  'coin_collector',
+  'first_purchase',
+];
 
 export default function Progress() {
   const user = useUserStore((state) => state.user);
@@ -9,7 +9,7 @@ import * as Haptics from 'expo-haptics';
 import { Audio, AVPlaybackSource } from 'expo-av';
 
 import { useUserStore } from '../../store/userStore';
-import { addCoins, addXP, updateProgress, unlockBadge, getProgress } from '../../utils/api';
+import { addCoins, addXP, updateProgress, getProgress, recordGameSession } from '../../utils/api';
 import Button from '../../components/Button';
 import CoinDisplay from '../../components/CoinDisplay';
 import { Colors, Spacing, FontSize, BorderRadius } from '../../constants/Colors';
@@ -58,7 +58,6 @@ export default function DebtGame() {
   const user = useUserStore((s) => s.user);
   const updateCoins = useUserStore((s) => s.updateCoins);
   const updateXP = useUserStore((s) => s.updateXP);
-  const addBadge = useUserStore((s) => s.addBadge);
 
   const [phase, setPhase] = useState<'intro' | 'playing' | 'summary'>('intro');
   const [idx, setIdx] = useState(0);
@@ -146,6 +145,9 @@ updateCoins(
       const xpRes = await addXP(user.id, xpEarned);
       updateXP(xpRes.new_xp, xpRes.new_level);
 
+      // Historial de partidas: si falla no debe bloquear el cierre del juego
+      recordGameSession({ user_id: user.id, module: 'debt_game', score: score, coins_earned: coinsEarned, xp_earned: xpEarned }).catch(() => {});
+
       const prog = await getProgress(user.id);
       const completed = prog.completed_modules || [];
       const module_scores = { ...(prog.module_scores || {}), debt_game: score };
@@ -154,7 +156,6 @@ updateCoins(
       if (!completed.includes('debt_game')) {
         completed.push('debt_game');
         await updateProgress({ user_id: user.id, completed_modules: completed, module_scores, total_score });
-        if (completed.length === 4) { await unlockBadge(user.id, 'financial_wizard'); addBadge('financial_wizard'); }
       }
 
       setFinal({open:true, title:'¡Felicidades! 🎉',
@@ -22,8 +22,8 @@ import {
   addCoins,
   addXP,
   updateProgress,
-  unlockBadge,
   getProgress,
+  recordGameSession,
   User,
   Progress,
 } from '../../../utils/api';
@@ -110,7 +110,6 @@ export default function CoinRecognition() {
   const user = useUserStore((s) => s.user as User | null);
   const updateCoins = useUserStore((s) => s.updateCoins);
   const updateXP = useUserStore((s) => s.updateXP);
-  const addBadge = useUserStore((s) => s.addBadge);
 
   // Montaje / desmontaje seguro
   const mountedRef = useRef(true);
@@ -289,6 +288,9 @@ export default function CoinRecognition() {
       const xpRes = await addXP(user.id, xpEarned);
       updateXP(xpRes.new_xp, xpRes.new_level);
 
+      // Historial de partidas: si falla no debe bloquear el cierre del juego
+      recordGameSession({ user_id: user.id, module: 'inicial/coin_recognition', score: scorePercentage, coins_earned: coinsEarned, xp_earned: xpEarned }).catch(() => {});
+
       const currentProgress = await getProgress(user.id);
       const moduleKey = 'coin_recognition';
       let progressNeedsUpdate = false;
@@ -302,9 +304,6 @@ export default function CoinRecognition() {
         newCompleted.push(moduleKey);
         newScores[moduleKey] = scorePercentage;
         newTotal += scorePercentage;
-        if (newCompleted.length === 1 && !user.badges.includes('first_module')) {
-          try { await unlockBadge(user.id, 'first_module'); addBadge('first_module'); } catch {}
-        }
       } else if (scorePercentage > existing) {
         progressNeedsUpdate = true;
         newScores[moduleKey] = scorePercentage;
@@ -8,7 +8,7 @@ import { Audio } from 'expo-av';
 import * as Haptics from 'expo-haptics';
 
 import { useUserStore } from '../../../store/userStore';
-import { addCoins, addXP, updateProgress, getProgress } from '../../../utils/api';
+import { addCoins, addXP, updateProgress, getProgress, recordGameSession } from '../../../utils/api';
 import Button from '../../../components/Button';
 import { Colors, Spacing, FontSize, BorderRadius } from '../../../constants/Colors';
 
@@ -151,6 +151,9 @@ export default function CountingMoney() {
       const xpResult = await addXP(user.id, xpEarned);
       updateXP(xpResult.new_xp, xpResult.new_level);
 
+      // Historial de partidas: si falla no debe bloquear el cierre del juego
+      recordGameSession({ user_id: user.id, module: 'inicial/counting_money', score: Math.round(score), coins_earned: coinsEarned, xp_earned: xpEarned }).catch(() => {});
+
       const curr = await getProgress(user.id);
       const completed = curr.completed_modules || [];
       if (!completed.includes('counting_money')) {
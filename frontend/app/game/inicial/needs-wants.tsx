@@ -15,7 +15,7 @@ import {
 import { useRouter } from 'expo-router';
 import { Audio } from 'expo-av';
 import { useUserStore } from '../../../store/userStore';
-import { addCoins, addXP, updateProgress, getProgress } from '../../../utils/api';
+import { addCoins, addXP, updateProgress, getProgress, recordGameSession } from '../../../utils/api';
 import Button from '../../../components/Button';
 import { Colors, Spacing, FontSize, BorderRadius } from '../../../constants/Colors';
 
@@ -284,6 +284,9 @@ export default function NeedsWants() {
       const xpResult = await addXP(user.id, xpEarned);
       updateXP(xpResult.new_xp, xpResult.new_level);
 
+      // Historial de partidas: si falla no debe bloquear el cierre del juego
+      recordGameSession({ user_id: user.id, module: 'inicial/needs_wants', score: Math.round(scorePercent), coins_earned: coinsEarned, xp_earned: xpEarned }).catch(() => {});
+
       const current = await getProgress(user.id);
       const completed = [...(current.completed_modules || [])];
       const moduleKey = 'needs_wants';
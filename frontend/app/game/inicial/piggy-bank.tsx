@@ -7,7 +7,7 @@ import { useRouter } from 'expo-router';
 import { Audio } from 'expo-av';
 import * as Haptics from 'expo-haptics';
 import { useUserStore } from '../../../store/userStore';
-import { addCoins, addXP, updateProgress, getProgress } from '../../../utils/api';
+import { addCoins, addXP, updateProgress, getProgress, recordGameSession } from '../../../utils/api';
 import Button from '../../../components/Button';
 import { Colors, Spacing, FontSize } from '../../../constants/Colors';
 
@@ -140,6 +140,9 @@ export default function PiggyBank() {
       await addCoins(user.id, coins).then(() => updateCoins(user.coins + coins));
       await addXP(user.id, xp).then((r) => updateXP(r.new_xp, r.new_level));
 
+      // Historial de partidas: si falla no debe bloquear el cierre del juego
+      recordGameSession({ user_id: user.id, module: 'inicial/piggy_bank', score: score, coins_earned: coins, xp_earned: xp }).catch(() => {});
+
       const progress = await getProgress(user.id).catch(() => ({
         completed_modules: [], module_scores: {}, total_score: 0,
       }));
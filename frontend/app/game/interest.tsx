@@ -2,7 +2,7 @@ import React, { useState } from 'react';
 import { View, Text, StyleSheet, ScrollView, TextInput, Alert } from 'react-native';
 import { useRouter } from 'expo-router';
 import { useUserStore } from '../../store/userStore';
-import { addCoins, addXP, updateProgress, unlockBadge, getProgress } from '../../utils/api';
+import { addCoins, addXP, updateProgress, getProgress, recordGameSession } from '../../utils/api';
 import Button from '../../components/Button';
 import CoinDisplay from '../../components/CoinDisplay';
 import { Colors, Spacing, FontSize, BorderRadius } from '../../constants/Colors';
@@ -19,7 +19,6 @@ export default function InterestGame() {
   const user = useUserStore((state) => state.user);
   const updateCoins = useUserStore((state) => state.updateCoins);
   const updateXP = useUserStore((state) => state.updateXP);
-  const addBadge = useUserStore((state) => state.addBadge);
 
   const [gamePhase, setGamePhase] = useState<'intro' | 'calculator' | 'comparison' | 'summary'>('intro');
   const [principal, setPrincipal] = useState('100');
@@ -79,6 +78,9 @@ export default function InterestGame() {
       const xpResult = await addXP(user.id, xpEarned);
       updateXP(xpResult.new_xp, xpResult.new_level);
 
+      // Historial de partidas: si falla no debe bloquear el cierre del juego
+      recordGameSession({ user_id: user.id, module: 'simple_interest', score: 100, coins_earned: coinsEarned, xp_earned: xpEarned }).catch(() => {});
+
       const currentProgress = await getProgress(user.id);
       const completedModules = currentProgress.completed_modules || [];
 
@@ -14,8 +14,8 @@ import { useUserStore } from '../../store/userStore';
 import {
   addCoins,
   addXP,
+  recordGameSession,
   updateProgress,
-  unlockBadge,
   getProgress,
 } from '../../utils/api';
 import Button from '../../components/Button';
@@ -44,7 +44,6 @@ export default function LemonadeGame() {
   const setUser = useUserStore((state) => state.setUser);
   const updateCoins = useUserStore((state) => state.updateCoins);
   const updateXP = useUserStore((state) => state.updateXP);
-  const addBadge = useUserStore((state) => state.addBadge);
 
   // Game state
   const [currentDay, setCurrentDay] = useState(1);
@@ -225,6 +224,9 @@ export default function LemonadeGame() {
       const xpResult = await addXP(user.id, xpEarned);
       updateXP(xpResult.new_xp, xpResult.new_level);
 
+      // Historial de partidas: si falla no debe bloquear el cierre del juego
+      recordGameSession({ user_id: user.id, module: 'lemonade_stand', score: score, coins_earned: coinsEarned, xp_earned: xpEarned }).catch(() => {});
+
       // Update progress
       const currentProgress = await getProgress(user.id);
       const completedModules = currentProgress.completed_modules || [];
@@ -241,15 +243,7 @@ export default function LemonadeGame() {
           },
           total_score: currentProgress.total_score + score,
         });
-
-        // Unlock badges
-        if (completedModules.length === 1) {
-          await unlockBadge(user.id, 'first_module');
-          addBadge('first_module');
-        }
-
-        await unlockBadge(user.id, 'lemonade_master');
-        addBadge('lemonade_master');
+        // Las insignias (first_module, lemonade_master) las otorga el backend en updateProgress
       }
 
       // Show level up if applicable
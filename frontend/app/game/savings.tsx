@@ -10,7 +10,7 @@ import {
 } from 'react-native';
 import { useRouter } from 'expo-router';
 import { useUserStore } from '../../store/userStore';
-import { addCoins, addXP, updateProgress, unlockBadge, getProgress } from '../../utils/api';
+import { addCoins, addXP, updateProgress, getProgress, recordGameSession } from '../../utils/api';
 import Button from '../../components/Button';
 import CoinDisplay from '../../components/CoinDisplay';
 import { Colors, Spacing, FontSize, BorderRadius } from '../../constants/Colors';
@@ -27,7 +27,6 @@ export default function SavingsGame() {
   const user = useUserStore((state) => state.user);
   const updateCoins = useUserStore((state) => state.updateCoins);
   const updateXP = useUserStore((state) => state.updateXP);
-  const addBadge = useUserStore((state) => state.addBadge);
 
   const [gamePhase, setGamePhase] = useState<'intro' | 'setup' | 'saving' | 'summary'>('intro');
   const [goal, setGoal] = useState('');
@@ -136,6 +135,9 @@ export default function SavingsGame() {
       const xpResult = await addXP(user.id, xpEarned);
       updateXP(xpResult.new_xp, xpResult.new_level);
 
+      // Historial de partidas: si falla no debe bloquear el cierre del juego
+      recordGameSession({ user_id: user.id, module: 'savings_challenge', score: score, coins_earned: coinsEarned, xp_earned: xpEarned }).catch(() => {});
+
       // Update progress
       const currentProgress = await getProgress(user.id);
       const completedModules = currentProgress.completed_modules || [];
@@ -152,10 +154,7 @@ export default function SavingsGame() {
           },
           total_score: currentProgress.total_score + score,
         });
-
-        // Unlock badge
-        await unlockBadge(user.id, 'saver');
-        addBadge('saver');
+        // La insignia 'saver' la otorga el backend en updateProgress
       }
 
       if (xpResult.level_up) {
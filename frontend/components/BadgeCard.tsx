@@ -33,6 +33,24 @@ const BADGES: Record<string, { icon: string; name: string; description: string;
     description: 'Completaste todos los módulos',
     color: '#9B59B6',
   },
+  xp_master: {
+    icon: 'flash',
+    name: 'Experto',
+    description: 'Alcanzaste 1000 puntos de experiencia',
+    color: '#F39C12',
+  },
+  coin_collector: {
+    icon: 'cash',
+    name: 'Coleccionista',
+    description: 'Juntaste 200 monedas',
+    color: '#27AE60',
+  },
+  first_purchase: {
+    icon: 'cart',
+    name: 'Primera Compra',
+    description: 'Compraste tu primer artículo en la tienda',
+    color: '#3498DB',
+  },
 };
 
 export default function BadgeCard({ badgeId, unlocked = false }: BadgeCardProps) {
@@ -1,6 +1,6 @@
 // store/userStore.ts
 import { create } from 'zustand';
-import { User } from '../utils/api';
+import { User, setBadgeListener } from '../utils/api';
 
 /** Tipo compatible con lo que llega de tu API + campos opcionales que usa la app */
 type UserLike = User & Partial<{
@@ -22,6 +22,7 @@ interface UserState {
   updateLevel: (level: string) => void;
 
   addBadge: (badgeId: string) => void;
+  addBadges: (badgeIds: string[]) => void;
   addPurchasedItem: (itemId: string) => void;
   updateEquippedItems: (equippedItems: Record<string, string>) => void;
 
@@ -58,6 +59,15 @@ export const useUserStore = create<UserState>((set) => ({
       return { user: { ...(state.user as any), badges: [...prev, badgeId] } as any };
     }),
 
+  addBadges: (badgeIds) =>
+    set((state): Partial<UserState> => {
+      if (!state.user) return { user: state.user };
+      const prev = state.user.badges ?? [];
+      const fresh = badgeIds.filter((id) => !prev.includes(id));
+      if (fresh.length === 0) return { user: state.user };
+      return { user: { ...(state.user as any), badges: [...prev, ...fresh] } as any };
+    }),
+
   addPurchasedItem: (itemId) =>
     set((state): Partial<UserState> => {
       if (!state.user) return { user: state.user };
@@ -73,3 +83,6 @@ export const useUserStore = create<UserState>((set) => ({
 
   logout: () => set({ user: null }),
 }));
+
+// Insignias otorgadas por el backend (campo new_badges de las respuestas)
+setBadgeListener((badgeIds) => useUserStore.getState().addBadges(badgeIds));
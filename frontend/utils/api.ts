@@ -12,6 +12,44 @@ export const api = axios.create({
   headers: { 'Content-Type': 'application/json' },
 });
 
+// ================== Token de sesión ==================
+// login/register devuelven un JWT de corta duración; los endpoints que
+// modifican datos lo exigen en Authorization.
+export const setAuthToken = (token?: string | null): void => {
+  if (token) api.defaults.headers.common.Authorization = `Bearer ${token}`;
+  else delete api.defaults.headers.common.Authorization;
+};
+
+// Si el token expiró, se reemite con login (solo requiere username) y se reintenta una vez
+api.interceptors.response.use(undefined, async (error) => {
+  const original = error?.config;
+  if (error?.response?.status !== 401 || !original || original._retried || original.url?.includes('/api/auth/')) {
+    throw error;
+  }
+  const stored = await getUserFromStorage();
+  if (!stored?.username) throw error;
+  const fresh = await loginUser(stored.username);
+  await saveUserToStorage(fresh);
+  original._retried = true;
+  original.headers = { ...(original.headers || {}), Authorization: `Bearer ${fresh.access_token}` };
+  return api.request(original);
+});
+
+// ================== Insignias del servidor ==================
+// addCoins/addXP/updateProgress/purchaseItem devuelven `new_badges` (las
+// reglas se evalúan en el backend). El store se suscribe para reflejarlas.
+type BadgeListener = (badgeIds: string[]) => void;
+let badgeListener: BadgeListener | null = null;
+
+export const setBadgeListener = (listener: BadgeListener | null): void => {
+  badgeListener = listener;
+};
+
+const notifyNewBadges = (data: any): void => {
+  const ids = data?.new_badges;
+  if (badgeListener && Array.isArray(ids) && ids.length > 0) badgeListener(ids);
+};
+
 // ================== Tipos ==================
 export interface User {
   id: string;
@@ -25,6 +63,7 @@ export interface User {
   purchased_items: string[];
   equipped_items: Record<string, string>;
   selected_level: string; // 'inicial' | 'primaria' | 'secundaria'
+  access_token?: string;
 }
 
 export interface Module {
@@ -59,14 +98,21 @@ export const registerUser = async (username: string, age: number): Promise<User>
     age,
     avatar_config: { color: 'blue', style: 'default' },
   });
+  setAuthToken(data?.access_token);
   return data;
 };
 
 export const loginUser = async (username: string): Promise<User> => {
   const { data } = await api.post('/api/auth/login', { username });
+  setAuthToken(data?.access_token);
   return data;
 };
 
+export const checkUsernameAvailable = async (username: string): Promise<boolean> => {
+  const { data } = await api.get('/api/auth/username-available', { params: { username } });
+  return !!data?.available;
+};
+
 // ================== Usuario ==================
 export const getUser = async (userId: string): Promise<User> => {
   const { data } = await api.get(`/api/user/${userId}`);
@@ -80,6 +126,7 @@ export const updateAvatar = async (userId: string, avatarConfig: any): Promise<U
 
 export const updateUserLevel = async (userId: string, level: string): Promise<User> => {
   const { data } = await api.put('/api/user/level', { user_id: userId, level });
+  setAuthToken(data?.access_token);
   return data;
 };
 
@@ -91,6 +138,7 @@ export const getProgress = async (userId: string): Promise<Progress> => {
 
 export const updateProgress = async (progress: Progress): Promise<any> => {
   const { data } = await api.post('/api/progress/update', progress);
+  notifyNewBadges(data);
   return data;
 };
 
@@ -110,11 +158,13 @@ export const getModulesByLevel = async (level: string): Promise<Module[]> => {
 export const addCoins = async (
   userId: string,
   coins: number
-): Promise<{ success: boolean; new_total: number }> => {
+): Promise<{ success: boolean; new_total: number; new_badges?: string[] }> => {
   const { data } = await api.post('/api/coins/add', { user_id: userId, coins });
+  notifyNewBadges(data);
   return data;
 };
 
+/** Solo para clientes antiguos: las insignias ya las otorga el backend. */
 export const unlockBadge = async (
   userId: string,
   badgeId: string
@@ -140,6 +190,31 @@ export const getLemonadeGame = async (userId: string): Promise<any | null> => {
   }
 };
 
+export interface GameSession {
+  user_id: string;
+  module: string;
+  score: number;
+  coins_earned?: number;
+  xp_earned?: number;
+  duration_seconds?: number;
+  completed?: boolean;
+  details?: Record<string, any>;
+  finished_at?: string;
+}
+
+export const recordGameSession = async (session: GameSession): Promise<{ success: boolean; id: string }> => {
+  const { data } = await api.post('/api/history', session);
+  return data;
+};
+
+export const getGameHistory = async (
+  userId: string,
+  params: { module?: string; since?: string; cursor?: string; limit?: number } = {}
+): Promise<{ sessions: (GameSession & { id: string })[]; next_cursor: string | null }> => {
+  const { data } = await api.get(`/api/history/${userId}`, { params });
+  return data;
+};
+
 // ================== Tienda ==================
 export const getShopItems = async (): Promise<ShopItem[]> => {
   const { data } = await api.get('/api/shop/items');
@@ -150,8 +225,9 @@ export const purchaseItem = async (
   userId: string,
   itemId: string,
   price: number
-): Promise<{ success: boolean; new_coins: number }> => {
+): Promise<{ success: boolean; new_coins: number; new_badges?: string[] }> => {
   const { data } = await api.post('/api/shop/purchase', { user_id: userId, item_id: itemId, price });
+  notifyNewBadges(data);
   return data;
 };
 
@@ -168,8 +244,17 @@ export const equipItem = async (
 export const addXP = async (
   userId: string,
   xp: number
-): Promise<{ success: boolean; new_xp: number; new_level: number; level_up: boolean; bonus_coins: number; total_coins: number }> => {
+): Promise<{
+  success: boolean;
+  new_xp: number;
+  new_level: number;
+  level_up: boolean;
+  bonus_coins: number;
+  total_coins: number;
+  new_badges?: string[];
+}> => {
   const { data } = await api.post('/api/xp/add', { user_id: userId, xp });
+  notifyNewBadges(data);
   return data;
 };
 
@@ -185,7 +270,9 @@ export const saveUserToStorage = async (user: User): Promise<void> => {
 export const getUserFromStorage = async (): Promise<User | null> => {
   try {
     const raw = await AsyncStorage.getItem('user');
-    return raw ? (JSON.parse(raw) as User) : null;
+    const user = raw ? (JSON.parse(raw) as User) : null;
+    if (user?.access_token) setAuthToken(user.access_token);
+    return user;
   } catch (e) {
     console.error('Failed to load user data from storage', e);
     return null;
@@ -195,6 +282,7 @@ export const getUserFromStorage = async (): Promise<User | null> => {
 export const clearStorage = async (): Promise<void> => {
   try {
     await AsyncStorage.removeItem('user');
+    setAuthToken(null);
   } catch (e) {
     console.error('Failed to clear user data from storage', e);
   }